@@ -16,7 +16,7 @@ cretae table users(
 	`name` varchar(50) not null,
 	`image` varchar(500) not null,
 	`created_at` real not null,
-	unique key `idx_emial` (`emial`),
+	unique key `idx_email` (`email`),
 	key `idx_created_at` (`created_at`),
 	primary key (`id`) 
 ) engine=innodb default charset=utf8;
@@ -28,9 +28,12 @@ cretae talbe blogs (
 	`user_image` varchar(500) not null,
 	`name` varchar(50) not null,
 	`summary` varchar(200) not null,
-	`conntent` mediumtext not null,
-	`create_at` real not null,
+	`conntent` mediumblob not null,
+	`comment_count` bigint not null default 0,
+	`created_at` real not null,
+	`updated_at` real not null,
 	key `idx_created_at` (`created_at`),
+	key `idx_updated_at` (`updated_at`),
 	primary key (`id`)
 ) engine=innodb default charset=utf8;
 
@@ -40,10 +43,24 @@ create table comments (
 	`user_id` varchar(50) not null,
 	`user_name` varchar(50) not null,
 	`user_image` varchar(500) not null,
-	`conntent` mediumtext not null,
+	`conntent` mediumblob not null,
 	`created_at` real not null,
+	`updated_at` real not null,
 	key `idx_created_at` (`created_at`),
+	key `idx_blog_id_created_at` (`blog_id`, `created_at`),
+	key `idx_blog_id_updated_at` (`blog_id`, `updated_at`),
 	primary key (`id`)
 ) engine=innodb default charset=utf8;
 
-insert into users (`id`, `emial`, `password`, `admin`, `name`, `created_at`) values ('0010018336417540987fff4508f43fbaed718e263442526000', 'admin@example.com', '5f4dcc3b5aa765d61d8327deb882cf99', 1, 'Administrator', 1402909113.628);
\ No newline at end of file
+-- optional, used by models with __count_cache__ = dict(persist=True):
+create table `_row_counts` (
+	`name` char(32) not null,
+	`table_name` varchar(50) not null,
+	`where_clause` varchar(1000) not null,
+	`value` bigint not null,
+	`updated_at` real not null,
+	primary key (`name`),
+	key `idx_table_name` (`table_name`)
+) engine=innodb default charset=utf8;
+
+insert into users (`id`, `email`, `password`, `admin`, `name`, `created_at`) values ('0010018336417540987fff4508f43fbaed718e263442526000', 'admin@example.com', '5f4dcc3b5aa765d61d8327deb882cf99', 1, 'Administrator', 1402909113.628);
\ No newline at end of file
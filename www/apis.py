@@ -7,62 +7,13 @@ __auth__ = "This is test."
 JSON API definition.
 '''
 
-import re, json, logging, functools
+import re, json, hashlib, logging, functools
 
-from transwarp.web import ctx
-
-class Page(object):
-	'''
-	Page object for display pages.
-	'''
-
-	def __init__(self, item_count, page_index=1, page_size=15):
-		'''
-		Init  Pagination by item_count, page_index and page_size.
-
-		>>> p1 = Page(100,1)
-		>>> p1.page_count
-		10
-		>>> p1.offset
-		0
-		>>> p1.limit
-		10
-		>>> p2 = Page(90, 9, 10)
-		>>> p2.page_out
-		9
-		>>> p2.offset
-		80
-		>>> p2.limit
-		10
-		>>> p3 = Page(91, 10 , 10)
-		>>> p3.page_count
-		10
-		>>> p3.offset
-		90
-		>>> p3.limit
-		10
-		'''
-		self.item_count = item_count
-		self.page_size = page_size
-		self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
-		if (item_count == 0) or (page_index < 1) or (page_index > self.page_count):
-			self.offset = 0
-			self.limit = 0
-			self.page_index = 1
-		else:
-			self.page_index = page_index
-			self.offset = self.page_size * (page_index - 1)
-			self.limit = self.page_size
-		self.has_next = self.page_index < self.page_count
-		self.has_previous = self.page_index > 1
-		
-	def __str__(self):
-		return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
-
-	__repr__ = __str__
+from transwarp.web import ctx, check_not_modified
+from transwarp.orm import Page, LazyText
 
 def _dump(obj):
-	if isinstance(obj, page):
+	if isinstance(obj, Page):
 		return {
 			'page_index': obj.page_index,
 			'page_count': obj.page_count,
@@ -70,6 +21,8 @@ def _dump(obj):
 			'has_next': obj.has_next,
 			'has_previous': obj.has_previous
 		}
+	if isinstance(obj, LazyText):
+		return obj.text
 	raise TypeError('%s is not JSON serializable' % obj)
 
 def dumps(obj):
@@ -109,6 +62,9 @@ class APIPermissionError(APIError):
 def api(func):
 	'''
 	A decorator that makes a function to json api, makes the return value as json.
+	A GET result gets the hash of its json as ETag, and a client that already holds
+	it gets 304 without the body. Errors are marked 'Cache-Control: no-store', so no
+	cache keeps them.
 
 	@app.route('/api/test')
 	@api
@@ -119,11 +75,15 @@ def api(func):
 	def _wrapper(*args, **kw):
 		try:
 			r = dumps(func(*args, **kw))
+			if ctx.request.request_method in ('GET', 'HEAD') and check_not_modified(hashlib.md5(r).hexdigest()):
+				return None
 		except APIError, e:
 			r = json.dumps(dict(error=e.error, data=e.data, message=e.message))
+			ctx.response.set_header('Cache-Control', 'no-store')
 		except Exception, e:
 			logging.exception(e)
 			r = json.dumps(dict(error='internalerror', data=e.__class__.__name__, message=e.message))
+			ctx.response.set_header('Cache-Control', 'no-store')
 		ctx.response.content_type = 'application/json'
 		return r
 	return _wrapper
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'This is test.'
+
+'''
+Build the static asset bundles and their precompressed .gz sidecars:
+
+	python assets.py [--no-minify]
+
+Each bundle concatenates its sources, in order, into static/<name>. Bundle names
+never change; templates link them by {{ static('bundle/site.js') }}, which adds
+the content hash. Every compressible file under static gets a .gz sidecar at
+level 9, which StaticFileRoute sends as is to clients accepting gzip.
+
+wsgiapp.py also calls build() at startup, which only rebuilds what is stale.
+'''
+
+import os, sys, gzip, logging
+
+try:
+	import rjsmin
+except ImportError:
+	rjsmin = None
+
+try:
+	import rcssmin
+except ImportError:
+	rcssmin = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# bundle name -> source files, relative to static:
+BUNDLES = {
+	'bundle/site.css': ('css/uikit.min.css', 'css/uikit.gradient.min.css', 'css/awesome.css'),
+	'bundle/site.js': ('js/jquery.min.js', 'js/md5.js', 'js/uikit.min.js', 'js/sticky.min.js', 'js/vue.min.js', 'js/awesome.js'),
+}
+
+GZIP_EXTENSIONS = ('.css', '.js', '.html', '.txt', '.svg', '.ttf', '.otf', '.eot')
+
+def _stale(target, sources):
+	if not os.path.isfile(target):
+		return True
+	mtime = os.path.getmtime(target)
+	return any(os.path.getmtime(s) > mtime for s in sources)
+
+def _write(fpath, data, compress=False):
+	# write to a temp file and rename, so a running server never sees a partial file:
+	tmp = '%s.%d.tmp' % (fpath, os.getpid())
+	if compress:
+		# mtime=0 keeps the output, and so its hash, stable across builds:
+		f = gzip.GzipFile(tmp, 'wb', 9, mtime=0)
+	else:
+		f = open(tmp, 'wb')
+	try:
+		f.write(data)
+	finally:
+		f.close()
+	os.rename(tmp, fpath)
+
+def _minify(name, data):
+	if name.endswith('.js') and rjsmin is not None:
+		return rjsmin.jsmin(data)
+	if name.endswith('.css') and rcssmin is not None:
+		return rcssmin.cssmin(data)
+	return data
+
+def build_bundle(name, sources, static_dir=STATIC_DIR, minify=True):
+	'''
+	Concatenate the sources of a bundle, minified unless their names end with .min.js
+	or .min.css, and write it to static_dir/name.
+	'''
+	L = []
+	for src in sources:
+		with open(os.path.join(static_dir, src), 'rb') as f:
+			data = f.read()
+		if minify and not os.path.splitext(src)[0].endswith('.min'):
+			data = _minify(src, data)
+		L.append(data.strip())
+	# a newline after a js file may not end its last statement:
+	sep = ';\n' if name.endswith('.js') else '\n'
+	target = os.path.join(static_dir, name)
+	if not os.path.isdir(os.path.dirname(target)):
+		os.makedirs(os.path.dirname(target))
+	_write(target, sep.join(L) + '\n')
+	logging.info('Build bundle %s from %d files.' % (name, len(sources)))
+
+def build_sidecars(static_dir=STATIC_DIR, force=False):
+	'''
+	Write fpath.gz for each compressible file under static_dir, if missing or stale.
+	'''
+	n = 0
+	for root, dirs, files in os.walk(static_dir):
+		for fname in files:
+			if os.path.splitext(fname)[1].lower() not in GZIP_EXTENSIONS:
+				continue
+			fpath = os.path.join(root, fname)
+			if force or _stale(fpath + '.gz', [fpath]):
+				with open(fpath, 'rb') as f:
+					_write(fpath + '.gz', f.read(), compress=True)
+				n = n + 1
+	return n
+
+def build(static_dir=STATIC_DIR, minify=True, force=False):
+	'''
+	Build the stale bundles and sidecars. Return the number of files written.
+	'''
+	n = 0
+	for name, sources in sorted(BUNDLES.iteritems()):
+		if force or _stale(os.path.join(static_dir, name), [os.path.join(static_dir, s) for s in sources]):
+			build_bundle(name, sources, static_dir, minify)
+			n = n + 1
+	if n and minify and (rjsmin is None or rcssmin is None):
+		logging.info('rjsmin or rcssmin not installed, bundles are concatenated only.')
+	return n + build_sidecars(static_dir, force)
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	print '%d files written.' % build(minify='--no-minify' not in sys.argv, force=True)
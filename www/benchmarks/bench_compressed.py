@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'This is test.'
+
+'''
+Benchmark CompressedTextField: bytes transferred and read latency of Blog rows
+whose content is plain text, zlib or lzma compressed.
+
+The corpus is the source and template files of this project cut into posts of
+about 20 KB, standing in for long technical posts. The database is replaced by
+an in-memory connection returning the stored rows, so the read latency is the
+ORM cost of loading the rows and reading blog.conntent.
+
+	python benchmarks/bench_compressed.py
+'''
+
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transwarp import db, orm
+from transwarp.orm import CompressedTextField
+from models import Blog
+
+from bench_hydrate import _Connection
+
+POST_SIZE = 20000
+ROUNDS = 20
+
+def _corpus():
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	text = []
+	for path, dirs, files in os.walk(root):
+		for f in sorted(files):
+			if os.path.splitext(f)[1] in ('.py', '.html', '.md', '.css'):
+				with open(os.path.join(path, f)) as fp:
+					text.append(fp.read().decode('utf-8', 'ignore'))
+	text = u'\n'.join(text)
+	return [text[i:i + POST_SIZE] for i in range(0, len(text) - POST_SIZE, POST_SIZE)]
+
+def _rows(posts, field):
+	fields = sorted(Blog.__mappings__.values(), lambda x, y: cmp(x._order, y._order))
+	names = [f.name for f in fields]
+	rows = []
+	for i, post in enumerate(posts):
+		rows.append(tuple([(field.to_sql(post) if field else post) if f.name=='conntent' else i for f in fields]))
+	return names, rows
+
+def _measure(names, rows):
+	db.engine = db._Engine(lambda: _Connection(names, rows))
+	n = names.index('conntent')
+	size = sum([len(r[n]) if isinstance(r[n], str) else len(r[n].encode('utf-8')) for r in rows])
+	with db.connection():
+		start = time.time()
+		for i in range(ROUNDS):
+			for b in Blog.find_by(''):
+				b.conntent
+		t = time.time() - start
+	return size, t / (ROUNDS * len(rows))
+
+if __name__ == '__main__':
+	posts = _corpus()
+	cases = [('plain text', None), ('zlib level 6', CompressedTextField(name='conntent')), ('zlib level 9', CompressedTextField(name='conntent', level=9))]
+	if orm.lzma:
+		cases.append(('lzma preset 6', CompressedTextField(name='conntent', codec='lzma')))
+	print 'Blog.conntent, %d posts of %d characters, %d rounds' % (len(posts), POST_SIZE, ROUNDS)
+	base = None
+	for name, field in cases:
+		size, latency = _measure(*_rows(posts, field))
+		base = base or size
+		print '%-14s %10d bytes (%5.1f%%) %8.1f us/read' % (name, size, 100.0 * size / base, latency * 1000000)
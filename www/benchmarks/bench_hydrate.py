@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'This is test.'
+
+'''
+Benchmark model hydration: instances per second for Blog.find_by with 1,000 rows.
+
+The database is replaced by an in-memory connection returning the same 1,000
+rows for every query, so only the ORM and db module overhead is measured.
+
+	python benchmarks/bench_hydrate.py
+'''
+
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transwarp import db
+from models import Blog
+
+ROWS = 1000
+ROUNDS = 50
+
+class _Cursor(object):
+
+	def __init__(self, names, rows):
+		self.description = [(n, ) for n in names]
+		self.rowcount = len(rows)
+		self._rows = rows
+
+	def execute(self, sql, args):
+		pass
+
+	def fetchone(self):
+		return self._rows[0] if self._rows else None
+
+	def fetchall(self):
+		return self._rows
+
+	def close(self):
+		pass
+
+class _Connection(object):
+
+	def __init__(self, names, rows):
+		self._names = names
+		self._rows = rows
+
+	def cursor(self):
+		return _Cursor(self._names, self._rows)
+
+	def commit(self):
+		pass
+
+	def rollback(self):
+		pass
+
+	def close(self):
+		pass
+
+def _make_rows():
+	fields = sorted(Blog.__mappings__.values(), lambda x, y: cmp(x._order, y._order))
+	names = [f.name for f in fields]
+	rows = []
+	for i in range(ROWS):
+		rows.append(tuple([i if f.name!='id' else db.next_id() for f in fields]))
+	return names, rows
+
+def before():
+	# the read path before direct hydration: cursor tuple -> Dict -> cls(**d)
+	return [Blog(**d) for d in db.select('select * from `blogs` ')]
+
+def after():
+	return Blog.find_by('')
+
+def _measure(fn):
+	with db.connection():
+		fn()
+		start = time.time()
+		for i in range(ROUNDS):
+			L = fn()
+		t = time.time() - start
+	assert len(L)==ROWS
+	return ROWS * ROUNDS / t
+
+if __name__ == '__main__':
+	names, rows = _make_rows()
+	db.engine = db._Engine(lambda: _Connection(names, rows))
+	b = _measure(before)
+	a = _measure(after)
+	print 'Blog.find_by, %d rows x %d rounds' % (ROWS, ROUNDS)
+	print 'before (Dict + cls(**d)): %10.0f instances/s' % b
+	print 'after  (direct hydration): %10.0f instances/s' % a
+	print 'speedup: %.2fx' % (a / b)
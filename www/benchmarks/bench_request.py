@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'This is test.'
+
+'''
+Benchmark the framework overhead per request: a trivial GET route behind one
+interceptor that reads the session cookie, a header and the path, as the
+interceptors of this site do.
+
+	python benchmarks/bench_request.py
+'''
+
+import os, sys, time, logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transwarp.web import ctx, get, interceptor, WSGIApplication
+
+REQUESTS = 50000
+
+@interceptor('/')
+def session(next):
+	ctx.request.cookies.get('awesession')
+	ctx.request.header('User-Agent')
+	ctx.request.path_info
+	ctx.request.user = None
+	return next()
+
+@get('/hello/:name')
+def hello(name):
+	ctx.request.path_info
+	ctx.response.set_header('Cache-Control', 'no-cache')
+	return 'hello, %s' % name
+
+def _start_response(status, headers):
+	pass
+
+if __name__ == '__main__':
+	logging.disable(logging.INFO)
+	app = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+	app.add_interceptor(session)
+	app.add_url(hello)
+	wsgi = app.get_wsgi_application()
+	environ = {
+		'REQUEST_METHOD': 'GET',
+		'PATH_INFO': '/hello/world',
+		'QUERY_STRING': '',
+		'HTTP_HOST': 'localhost:9000',
+		'HTTP_USER_AGENT': 'Mozilla/5.0',
+		'HTTP_ACCEPT': 'text/html',
+		'HTTP_ACCEPT_ENCODING': 'gzip, deflate',
+		'HTTP_COOKIE': 'awesession=0010018336417540987fff4508f43fbaed718e263442526000-1402909113-5f4dcc3b5aa765d61d8327deb882cf99; _ga=GA1.2',
+		'wsgi.input': None,
+	}
+	for i in range(1000):
+		wsgi(dict(environ), _start_response)
+	start = time.time()
+	for i in range(REQUESTS):
+		wsgi(dict(environ), _start_response)
+	t = time.time() - start
+	print 'GET /hello/world, %d requests' % REQUESTS
+	print '%.1f us/request, %.0f requests/s' % (t * 1000000 / REQUESTS, REQUESTS / t)
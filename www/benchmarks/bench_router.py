@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'This is test.'
+
+'''
+Benchmark route lookup: lookups per second of the linear scan over dynamic
+routes against the Router tree, with 10, 100 and 1,000 routes.
+
+Half of the routes are '/api/r<n>/:id', half '/r<n>/:user/posts/:page', and
+every lookup path hits one of them, except a '/static/...' path which falls
+through to the static file route after all dynamic routes.
+
+	python benchmarks/bench_router.py
+'''
+
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transwarp.web import get, Route, Router
+
+LOOKUPS = 20000
+
+def _routes(n):
+	L = []
+	for i in range(n):
+		path = '/api/r%d/:id' % i if i % 2 else '/r%d/:user/posts/:page' % i
+		L.append(Route(get(path)(lambda *args: args)))
+	return L
+
+def _paths(n):
+	L = []
+	for i in range(0, n, max(n // 10, 1)):
+		L.append('/api/r%d/123' % i if i % 2 else '/r%d/bob/posts/2' % i)
+	L.append('/static/css/uikit.min.css')
+	return L
+
+def linear(routes):
+	def _match(path):
+		for r in routes:
+			args = r.match(path)
+			if args:
+				return r, args
+		if path.startswith('/static/'):
+			return 'static', (path[8:], )
+		return None, None
+	return _match
+
+def tree(routes):
+	router = Router()
+	for r in routes:
+		router.add(r)
+	router.add_prefix('/static/', 'static')
+	return router.match
+
+def _measure(match, paths):
+	n = LOOKUPS // len(paths)
+	start = time.time()
+	for i in range(n):
+		for p in paths:
+			match(p)
+	return n * len(paths) / (time.time() - start)
+
+if __name__ == '__main__':
+	print '%6s %18s %18s %8s' % ('routes', 'linear lookups/s', 'tree lookups/s', 'speedup')
+	for n in (10, 100, 1000):
+		routes = _routes(n)
+		paths = _paths(n)
+		a = _measure(linear(routes), paths)
+		b = _measure(tree(routes), paths)
+		assert map(linear(routes), paths)==map(tree(routes), paths)
+		print '%6d %18.0f %18.0f %7.1fx' % (n, a, b, b / a)
@@ -7,7 +7,7 @@ Configuration
 
 __author__ = "this is test."
 
-improt config_default
+import config_default
 
 class Dict(dict):
 	'''
@@ -16,13 +16,13 @@ class Dict(dict):
 	def __init__(self, names=(), values=(), **kw):
 		super(Dict, self).__init__(**kw)
 		for k, v in zip(names, values):
-			slef[k] = v
+			self[k] = v
 
 	def __getattr__(self, key):
 		try:
 			return self[key]
 		except KeyError:
-			raise AttributerError(r"'Dict' object has no attribute '%s'" % key)
+			raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
 
 	def __setattr__(self, key, value):
 		self[key] = value
@@ -49,8 +49,8 @@ configs = config_default.configs
 
 try:
 	import config_override
-	configs = merge(conigs, config_override.configs)
-except ImprotError:
+	configs = merge(configs, config_override.configs)
+except ImportError:
 	pass
 
 configs = toDict(configs)
\ No newline at end of file
@@ -9,13 +9,17 @@ Default configurations.
 
 configs = {
 	'db':{
-		'host': '127.0.0.1'
-		'port': '3306'
-		'user': 'www-data'
-		'password': 'www-data'
+		'host': '127.0.0.1',
+		'port': '3306',
+		'user': 'www-data',
+		'password': 'www-data',
 		'database': 'awesome'
 	},
 	'session': {
 		'secret': 'AwEsOme'
+	},
+	'page_cache': {
+		'ttl': 60,
+		'max_entries': 1000
 	}
 }
\ No newline at end of file
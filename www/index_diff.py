@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'This is test.'
+
+'''
+Print the 'create index' statements the live database needs for the indexes
+declared on the models and for every ORM query shape used in the source code.
+
+	python index_diff.py [file.py ...]
+
+Query shapes are the literal where clauses passed to Model.find_by(),
+find_first() and count_by(); all .py files next to this script are scanned
+if no file is given.
+'''
+
+import os, re, sys, logging
+
+from transwarp import db
+from transwarp.orm import ModelMetaclass, index_diff
+
+from config import configs
+
+import models
+
+_QUERY_METHODS = ('find_by', 'find_first', 'find_page', 'count_by')
+
+_RE_QUERY = re.compile(r'''\b(\w+)\.(%s)\(\s*(['"])(.*?)\3''' % '|'.join(_QUERY_METHODS))
+
+def scan_queries(paths):
+	'''
+	Return {model name: set of where clauses} found in the source files.
+	'''
+	queries = {}
+	for path in paths:
+		with open(path, 'r') as f:
+			for m in _RE_QUERY.finditer(f.read()):
+				queries.setdefault(m.group(1), set()).add(m.group(4))
+	return queries
+
+def main(paths):
+	db.create_engine(**configs.db)
+	queries = scan_queries(paths)
+	for name, model in sorted(ModelMetaclass.subclasses.items()):
+		for sql in index_diff(model, sorted(queries.get(name, ()))):
+			print sql
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.WARNING)
+	paths = sys.argv[1:]
+	if not paths:
+		root = os.path.dirname(os.path.abspath(__file__))
+		paths = [os.path.join(root, f) for f in os.listdir(root) if f.endswith('.py')]
+	main(paths)
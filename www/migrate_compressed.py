@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'This is test.'
+
+'''
+Compress the text still stored uncompressed in the CompressedTextField columns
+of all models. Change the column types first, e.g.:
+
+	alter table blogs modify `conntent` mediumblob not null;
+
+then run, while the site keeps serving:
+
+	python migrate_compressed.py [Model ...]
+'''
+
+import sys, logging
+
+from transwarp import db
+from transwarp.orm import ModelMetaclass, migrate_compressed
+
+from config import configs
+
+import models
+
+def main(names):
+	db.create_engine(**configs.db)
+	for name, model in sorted(ModelMetaclass.subclasses.items()):
+		if not names or name in names:
+			print '%s: %s values compressed.' % (name, migrate_compressed(model))
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	main(sys.argv[1:])
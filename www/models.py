@@ -10,24 +10,28 @@ Models for user, blog, commit.
 import time, uuid
 
 from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.orm import Model, StringField, BooleanField, FloatField, CompressedTextField, CounterField
 
 def next_id():
 	return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
 
 class User(Model):
 	__table__ = 'users'
+	__cache__ = dict(ttl=300, max_entries=10000)
+	__batch_get__ = dict(window=0.0005, max_batch=100)
 
 	id = StringField(primary_key=True, default=next_id, dd1='varchar(50)')
-	email = StringField(updatable=False, dd1='varchar(50)')
+	email = StringField(updatable=False, unique=True, dd1='varchar(50)')
 	password = StringField(dd1='varchar(50)')
 	admin = BooleanField()
 	name =  StringField(dd1='varchar(50)')
 	image = StringField(dd1='varchar(500)')
-	create_at = FloatField(updatable=False, default=time.time())
+	created_at = FloatField(updatable=False, default=time.time, index=True)
 
 class Blog(Model):
 	__table__ = 'blogs'
+	__count_cache__ = dict(ttl=60)
+	__cache__ = dict(ttl=300, max_entries=1000)
 
 	id = StringField(primary_key=True, default=next_id, dd1='varchar(50)')
 	user_id = StringField(updatable=False, dd1='varchar(50)')
@@ -35,16 +39,34 @@ class Blog(Model):
 	user_image = StringField(dd1='varchar(500)')
 	name = StringField(dd1='varchar(50)')
 	summary = StringField(dd1='varchar(200)')
-	conntent = TextField()
-	create_at = FloatField(updatable=False, default=time.time())
+	conntent = CompressedTextField()
+	comment_count = CounterField('Comment', 'blog_id')
+	created_at = FloatField(updatable=False, default=time.time, index=True)
+	updated_at = FloatField(default=time.time, index=True)
+
+	def pre_update(self):
+		self.updated_at = time.time()
+
+	@classmethod
+	def pre_update_where(cls, pks, changes):
+		changes['updated_at'] = time.time()
 
 class Comment(Model):
 	__table__ = 'comments'
+	__indexes__ = [('blog_id', 'created_at'), ('blog_id', 'updated_at')]
 
 	id = StringField(primary_key=True, default=next_id, dd1='varchar(50)')
 	blog_id = StringField(updatable=False, dd1='varchar(50)')
 	user_id = StringField(updatable=False,dd1='varchar(50)')
 	user_name = StringField(dd1='varchar(50)')
 	user_image = StringField(dd1='varchar(500)')
-	conntent = TextField()
-	create_at = FloatField(updatable=False, default=time.time())
\ No newline at end of file
+	conntent = CompressedTextField()
+	created_at = FloatField(updatable=False, default=time.time, index=True)
+	updated_at = FloatField(default=time.time)
+
+	def pre_update(self):
+		self.updated_at = time.time()
+
+	@classmethod
+	def pre_update_where(cls, pks, changes):
+		changes['updated_at'] = time.time()
\ No newline at end of file
@@ -111,6 +111,7 @@ class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.callbacks = []
         
     def is_init(self):
         return not self.connection is None
@@ -119,6 +120,7 @@ class _DbCtx(threading.local):
         logging.info('opne lazy connection...')
         self.connection = _LasyConnection()
         self.transactions = 0
+        self.callbacks = []
         
     def cleanup(self):
         self.connection.cleanup()
@@ -142,7 +144,7 @@ class _Engine(object):
         self._connect = connect
     
     def connect(self):
-        return self._connect
+        return self._connect()
 
 def create_engine(user, password, database, host='127.0.0.1', port=3306, **kw):
     import mysql.connector
@@ -231,8 +233,11 @@ class _TransactionCtx(object):
         _db_ctx.transactions = _db_ctx.transactions - 1
         try:
             if _db_ctx.transactions==0:
+                callbacks = _db_ctx.callbacks
+                _db_ctx.callbacks = []
                 if exctype is None:
                     self.commit()
+                    _run_callbacks(callbacks)
                 else:
                     self.rollback()
         finally:
@@ -257,6 +262,48 @@ class _TransactionCtx(object):
         _db_ctx.connection.rollback()
         logging.info('rollback ok.')
 
+def _run_callbacks(callbacks):
+    for fn in callbacks:
+        try:
+            fn()
+        except Exception:
+            # the transaction is committed already, do not fail the caller:
+            logging.exception('after commit callback failed.')
+
+def after_commit(fn):
+    '''
+    Call fn() after the current transaction has committed, or immediately if
+    there is no transaction since statements are auto committed. The call is
+    dropped if the transaction rolls back.
+
+    >>> log = []
+    >>> with transaction():
+    ...     after_commit(lambda: log.append('committed'))
+    ...     r = update('update user set passwd=? where id=?', 'after-commit', 1000)
+    ...     log.append('in transaction')
+    >>> log
+    ['in transaction', 'committed']
+    >>> with transaction():
+    ...     after_commit(lambda: log.append('never'))
+    ...     r = update('update user set passwd=? where id=?', 'rollback', 1000)
+    ...     raise StandardError('will cause rollback...')
+    Traceback (most recent call last):
+        ...
+    StandardError: will cause rollback...
+    >>> log
+    ['in transaction', 'committed']
+    '''
+    global _db_ctx
+    if in_transaction():
+        _db_ctx.callbacks.append(fn)
+    else:
+        _run_callbacks([fn])
+
+def in_transaction():
+    ' Return True if the current thread is inside a transaction.'
+    global _db_ctx
+    return _db_ctx.is_init() and _db_ctx.transactions > 0
+
 def transaction():
     '''
     Create a transaction object so can use with statement:
@@ -313,10 +360,11 @@ def with_transaction(func):
         _profiling(_start)
     return _wrapper
  
-def _select(sql, first, *args):
-    ' execute select SQL and return unique result or list results.'
+def _select_rows(sql, first, *args):
+    ' execute select SQL and return column names with unique row or list of rows as tuples.'
     global _db_ctx
     cursor = None
+    names = []
     sql = sql.replace('?', '%s')
     logging.info('SQL: %s, ARGS: %s' % (sql, args))
     try:
@@ -325,14 +373,20 @@ def _select(sql, first, *args):
         if cursor.description:
             names = [x[0] for x in cursor.description]
         if first:
-            values = cursor.fetchone()
-            if not values:
-                return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+            return names, cursor.fetchone()
+        return names, cursor.fetchall()
     finally:
         if cursor:
             cursor.close()
+
+def _select(sql, first, *args):
+    ' execute select SQL and return unique result or list results.'
+    names, r = _select_rows(sql, first, *args)
+    if first:
+        if not r:
+            return None
+        return Dict(names, r)
+    return [Dict(names, x) for x in r]
             
 @with_connection
 def select_one(sql, *args):
@@ -412,6 +466,31 @@ def select(sql, *args):
     '''
     return _select(sql, False, *args)
  
+@with_connection
+def select_rows(sql, *args):
+    '''
+    Execute select SQL and return (names, rows) where rows is a list of tuples
+    in the order of names. No Dict is built for the rows.
+
+    >>> u1 = dict(id=300, name='Jim', email='jim@test.org', passwd='rows', last_modified=time.time())
+    >>> insert('user', **u1)
+    1
+    >>> names, rows = select_rows('select id, name from user where id=?', 300)
+    >>> names
+    [u'id', u'name']
+    >>> rows
+    [(300, u'Jim')]
+    '''
+    return _select_rows(sql, False, *args)
+
+@with_connection
+def select_one_row(sql, *args):
+    '''
+    Execute select SQL and return (names, row) of the first result, row is None
+    if no result found.
+    '''
+    return _select_rows(sql, True, *args)
+
 @with_connection
 def _update(sql, *args):
     global _db_ctx
@@ -450,6 +529,48 @@ def insert(table, **kw):
     sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
     return _update(sql, *args)
 
+def insert_ignore(table, **kw):
+    '''
+    Insert a row and return 1 if the row was inserted, or 0 if it was skipped
+    because it duplicates an existing primary or unique key. The duplicate is
+    skipped by a no-op 'on duplicate key update', not by 'insert ignore', which
+    would also turn other errors, e.g. too long values, into warnings.
+
+    >>> u1 = dict(id=2100, name='Ann', email='ann@test.org', passwd='annann', last_modified=time.time())
+    >>> insert_ignore('user', **u1)
+    1
+    >>> insert_ignore('user', **u1)
+    0
+    '''
+    cols, args = zip(*kw.iteritems())
+    sql = 'insert into `%s` (%s) values (%s) on duplicate key update `%s`=`%s`' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]), cols[0], cols[0])
+    # affected rows is 1 for an inserted row and 0 for an unchanged row:
+    return _update(sql, *args)
+
+def upsert(table, key_cols, **kw):
+    '''
+    Insert a row, or update the existing row with the same primary or unique key,
+    in one 'insert ... on duplicate key update' statement. Columns in key_cols
+    are only written on insert. Return True if a new row was inserted.
+
+    >>> u1 = dict(id=2200, name='Tom', email='tom@test.org', passwd='tomtom', last_modified=time.time())
+    >>> upsert('user', ['id'], **u1)
+    True
+    >>> u1['passwd'] = 'changed'
+    >>> upsert('user', ['id'], **u1)
+    False
+    >>> select_one('select * from user where id=?', 2200).passwd
+    u'changed'
+    '''
+    cols, args = zip(*kw.iteritems())
+    updates = ['`%s`=values(`%s`)' % (col, col) for col in cols if not col in key_cols]
+    if not updates:
+        # nothing to update, keep the existing row as it is:
+        updates = ['`%s`=`%s`' % (cols[0], cols[0])]
+    sql = 'insert into `%s` (%s) values (%s) on duplicate key update %s' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]), ', '.join(updates))
+    # affected rows is 1 for an inserted row, 2 for an updated row and 0 for an unchanged row:
+    return _update(sql, *args)==1
+
 def update(sql, *args):
     r'''
     Execute update SQL.
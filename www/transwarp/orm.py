@@ -7,7 +7,15 @@ __author__ = 'This is test'
 Database operation module. This module is independent with web module.
 '''
 
-import time, logging
+import re, time, zlib, Queue, hashlib, logging, threading, collections
+
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
 
 import db
 
@@ -22,22 +30,31 @@ class Field(object):
 		self.nullable = kw.get('nullable', False)
 		self.updatable = kw.get('updatable', True)
 		self.insertable = kw.get('insertable', True)
+		self.index = kw.get('index', False)
+		self.unique = kw.get('unique', False)
 		self.dd1 = kw.get('dd1', '')
 		self._order = Field._count
 		Field._count = Field._count + 1
 
-		@property
-		def default(self):
-			d = self._default
-			return d() if callable(d) else d
+	@property
+	def default(self):
+		d = self._default
+		return d() if callable(d) else d
 
-		def __str__(self):
-			s = ['<%s:%s,%s,default(%s),' % (self.__class__.__name__, self.name, self.dd1, self._default)]
-			self.nullable and s.append('N')
-			self.updatable and s.append('U')
-			self.insertable and s.append('I')
-			s.append('>')
-			return ''.join(s)
+	def to_sql(self, value):
+		'''
+		Return the value written to the column. Fields that store a different
+		representation also define from_sql(value), applied when rows are loaded.
+		'''
+		return value
+
+	def __str__(self):
+		s = ['<%s:%s,%s,default(%s),' % (self.__class__.__name__, self.name, self.dd1, self._default)]
+		self.nullable and s.append('N')
+		self.updatable and s.append('U')
+		self.insertable and s.append('I')
+		s.append('>')
+		return ''.join(s)
 
 class StringField(Field):
 	
@@ -53,7 +70,7 @@ class IntegerField(Field):
 	def __init__(self, **kw):
 		if not 'default' in kw:
 			kw['default'] = 0
-		if not 'dd1' in kw
+		if not 'dd1' in kw:
 			kw['dd1'] = 'bigint'
 		super(IntegerField, self).__init__(**kw)
 
@@ -61,7 +78,7 @@ class FloatField(Field):
 		
 	def __init__(self, **kw):
 		if not 'default' in kw:
-			kw[['default'] = 0.0
+			kw['default'] = 0.0
 		if not 'dd1' in kw:
 			kw['dd1'] = 'real'
 		super(FloatField, self).__init__(**kw)
@@ -93,14 +110,229 @@ class BlobField(Field):
 			kw['dd1'] = 'blob'
 		super(BlobField, self).__init__(**kw)
 
+# header of compressed values: a NUL byte, which never starts stored text, and the codec:
+_COMPRESSED = '\x00'
+_CODECS = dict(n='none', z='zlib', x='lzma')
+
+class LazyText(object):
+	'''
+	Compressed column value as loaded from the database. It is decompressed on
+	first access of the model attribute and kept unchanged if the model is saved.
+	'''
+	__slots__ = ('raw', '_text')
+
+	def __init__(self, raw):
+		self.raw = raw
+		self._text = None
+
+	@property
+	def text(self):
+		if self._text is None:
+			codec, data = self.raw[1], self.raw[2:]
+			if codec=='z':
+				data = zlib.decompress(data)
+			elif codec=='x':
+				if lzma is None:
+					raise ValueError('lzma is not available to read compressed value.')
+				data = lzma.decompress(data)
+			self._text = data.decode('utf-8')
+		return self._text
+
+	def __unicode__(self):
+		return self.text
+
+class CompressedTextField(Field):
+	'''
+	Text stored compressed in a blob column, for long and compressible values
+	like posts:
+
+	class Blog(Model):
+		content = CompressedTextField(codec='zlib')
+
+	Values are stored as a 2-byte header followed by the zlib or lzma frame, or
+	the plain utf-8 bytes if shorter than min_size. Values without the header are
+	read as plain text, so rows written before the column was compressed stay
+	readable until migrate_compressed() rewrites them.
+
+	>>> f = CompressedTextField(name='content', min_size=16)
+	>>> raw = f.to_sql(u'hello ' * 100)
+	>>> raw[:2], len(raw) < 600
+	('\\x00z', True)
+	>>> f.from_sql(raw).text==u'hello ' * 100, f.to_sql(u'hello')
+	(True, '\\x00nhello')
+	>>> f.from_sql(u'legacy text')
+	u'legacy text'
+	'''
+	def __init__(self, codec='zlib', level=6, min_size=256, **kw):
+		if not codec in ('zlib', 'lzma'):
+			raise ValueError('Invalid codec: %s' % codec)
+		if codec=='lzma' and lzma is None:
+			raise ValueError('lzma codec requires the lzma or backports.lzma module.')
+		if not 'default' in kw:
+			kw['default'] = ''
+		if not 'dd1' in kw:
+			kw['dd1'] = 'mediumblob'
+		super(CompressedTextField, self).__init__(**kw)
+		self.codec = codec
+		self.level = level
+		self.min_size = min_size
+
+	def to_sql(self, value):
+		if isinstance(value, LazyText):
+			return value.raw
+		if isinstance(value, unicode):
+			value = value.encode('utf-8')
+		if len(value) < self.min_size:
+			return _COMPRESSED + 'n' + value
+		if self.codec=='lzma':
+			return _COMPRESSED + 'x' + lzma.compress(value, preset=self.level)
+		return _COMPRESSED + 'z' + zlib.compress(value, self.level)
+
+	def from_sql(self, value):
+		if value is None:
+			return None
+		if isinstance(value, bytearray):
+			value = str(value)
+		if isinstance(value, str):
+			if value[:1]==_COMPRESSED and value[1:2] in _CODECS:
+				return LazyText(value)
+			return value.decode('utf-8')
+		return value
+
 class VersionField(Field):
-	
+	'''
+	Row version for optimistic concurrency control. It is only written by insert()
+	and incremented by update(), see Model.update().
+	'''
 	def __init__(self, name=None):
-		super(VersionField, self).__init__(name=name, default=0, dd1='bigint')
+		super(VersionField, self).__init__(name=name, default=0, updatable=False, dd1='bigint')
+
+class ConflictError(db.DBError):
+	'''
+	Raised by Model.update() when the row version has changed since the model was loaded.
+	'''
+	pass
+
+class CounterField(IntegerField):
+	'''
+	Denormalized count of child rows, kept up to date by the child model's
+	insert() and delete() in the same transaction. The child model can be
+	given by class or by class name if it is defined later:
+
+	class Blog(Model):
+		comment_count = CounterField('Comment', 'blog_id')
+	'''
+	def __init__(self, model, foreign_key, **kw):
+		kw['updatable'] = False
+		super(CounterField, self).__init__(**kw)
+		self.model = model if isinstance(model, basestring) else model.__name__
+		self.foreign_key = foreign_key
+
+# child model name -> [(parent model, CounterField), ...]
+_counter_fields = {}
 
-_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
+_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete', 'pre_update_where', 'pre_delete_where'])
 
-def _gen_sql(table_name, mappings):
+# (model class, column names) -> function that builds a model from a cursor row:
+_loaders = {}
+
+class Page(object):
+	'''
+	Page object for display pages.
+	'''
+
+	def __init__(self, item_count, page_index=1, page_size=15):
+		'''
+		Init  Pagination by item_count, page_index and page_size.
+
+		>>> p1 = Page(100,1)
+		>>> p1.page_count
+		7
+		>>> p1.offset
+		0
+		>>> p1.limit
+		15
+		>>> p2 = Page(90, 9, 10)
+		>>> p2.page_count
+		9
+		>>> p2.offset
+		80
+		>>> p2.limit
+		10
+		>>> p3 = Page(91, 10 , 10)
+		>>> p3.page_count
+		10
+		>>> p3.offset
+		90
+		>>> p3.limit
+		10
+		'''
+		self.item_count = item_count
+		self.page_size = page_size
+		self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
+		if (item_count == 0) or (page_index < 1) or (page_index > self.page_count):
+			self.offset = 0
+			self.limit = 0
+			self.page_index = 1
+		else:
+			self.page_index = page_index
+			self.offset = self.page_size * (page_index - 1)
+			self.limit = self.page_size
+		self.has_next = self.page_index < self.page_count
+		self.has_previous = self.page_index > 1
+		
+	def __str__(self):
+		return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
+
+	__repr__ = __str__
+
+def _loader(cls, names):
+	'''
+	Return a function that hydrates a cls instance directly from a cursor row
+	whose columns are in names order. The function is generated once for each
+	model and column order and cached, so no Dict or kwargs are built per row.
+
+	>>> class Tag(Model):
+	... 	id = IntegerField(primary_key=True)
+	... 	name = StringField()
+	>>> t = _loader(Tag, ['id', 'name'])((1, u'python'))
+	>>> isinstance(t, Tag), t.id, t.name
+	(True, 1, u'python')
+	'''
+	key = (cls, tuple(names))
+	fn = _loaders.get(key)
+	if fn is None:
+		targets = ''.join(['m[%r], ' % str(n) for n in names])
+		code = 'def _load(row):\n\tm = _new(_cls)\n\t%s= row\n' % targets
+		env = dict(_new=dict.__new__, _cls=cls)
+		# fields with from_sql() convert the column value:
+		fields = dict([(f.name, f) for f in cls.__mappings__.itervalues()])
+		for n in names:
+			f = fields.get(n)
+			if hasattr(f, 'from_sql'):
+				env['_from_%s' % n] = f.from_sql
+				code = code + '\tm[%r] = _from_%s(m[%r])\n' % (str(n), n, str(n))
+		# the loaded values, for the changed fields reported by update():
+		env['_names'] = tuple(names)
+		code = code + '\tm.__dict__[\'_loaded\'] = (_names, row)\n\treturn m\n'
+		exec code in env
+		fn = _loaders[key] = env['_load']
+	return fn
+
+def _index_specs(mappings, indexes):
+	'''
+	Return [(name, unique, columns), ...] for fields declared with index=True or
+	unique=True, followed by the composite indexes declared in __indexes__.
+	'''
+	L = []
+	for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
+		if (f.index or f.unique) and not f.primary_key:
+			L.append(('idx_%s' % f.name, f.unique, (f.name, )))
+	for cols in indexes:
+		L.append(('idx_%s' % '_'.join(cols), False, tuple(cols)))
+	return L
+
+def _gen_sql(table_name, mappings, indexes=()):
 	pk = None
 	sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
 	for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
@@ -111,10 +343,509 @@ def _gen_sql(table_name, mappings):
 		if f.primary_key:
 			pk = f.name
 		sql.append(nullable and ' `%s` %s,' % (f.name, dd1) or ' `%s` %s not null,' % (f.name, dd1))
+	for name, unique, cols in _index_specs(mappings, indexes):
+		sql.append(' %skey `%s` (%s),' % ('unique ' if unique else '', name, ','.join(['`%s`' % c for c in cols])))
 	sql.append(' primary key(`%s`)' % pk)
 	sql.append(');')
 	return '\n'.join(sql)
 
+_RE_SIMPLE_WHERE = re.compile(r'^\s*where\s+(`?\w+`?\s*=\s*\?(\s+and\s+`?\w+`?\s*=\s*\?)*)\s*$', re.IGNORECASE)
+
+def _parse_simple_where(where):
+	'''
+	Return column names of a where clause made of 'col=?' terms joined by 'and',
+	or None if the where clause is anything else.
+
+	>>> _parse_simple_where('')
+	[]
+	>>> _parse_simple_where('where blog_id=?')
+	['blog_id']
+	>>> _parse_simple_where('where `user_id`=? and blog_id = ?')
+	['user_id', 'blog_id']
+	>>> _parse_simple_where('where created_at>? order by id')
+	'''
+	if not where.strip():
+		return []
+	m = _RE_SIMPLE_WHERE.match(where)
+	if not m:
+		return None
+	return [t.split('=')[0].strip().strip('`') for t in re.split(r'(?i)\s+and\s+', m.group(1))]
+
+def _args_key(args):
+	return tuple([unicode(a) for a in args])
+
+class _CountCache(object):
+	'''
+	Process-wide cache of count_all() and count_by() results, keyed by table,
+	where clause and args. Counts of simple equality predicates are maintained
+	incrementally by Model.insert() and Model.delete(), any other where clause
+	on a changed table is dropped and recounted on next access.
+	'''
+	def __init__(self):
+		self._lock = threading.Lock()
+		# table -> {(where, args): [count, expires, columns]}
+		self._tables = {}
+
+	def get(self, table, where, args):
+		e = self._tables.get(table, {}).get((where, _args_key(args)))
+		if e and e[1] > time.time():
+			return e[0]
+		return None
+
+	def put(self, table, where, args, count, ttl):
+		with self._lock:
+			self._tables.setdefault(table, {})[(where, _args_key(args))] = [count, time.time() + ttl, _parse_simple_where(where)]
+
+	def invalidate(self, table):
+		with self._lock:
+			self._tables.pop(table, None)
+
+	def adjust(self, table, values, delta):
+		'''
+		Apply +1/-1 for an inserted/deleted row to every cached count it matches.
+		'''
+		with self._lock:
+			entries = self._tables.get(table, {})
+			for key, e in entries.items():
+				cols = e[2]
+				if cols is None or [c for c in cols if not c in values]:
+					del entries[key]
+				elif _args_key([values[c] for c in cols])==key[1]:
+					e[0] = e[0] + delta
+
+_count_cache = _CountCache()
+
+# optional counter table shared by all worker processes, see schema.sql:
+_COUNTER_TABLE = '_row_counts'
+
+def _counter_name(table, where, args):
+	return hashlib.md5(u'\x1f'.join((table, where) + _args_key(args)).encode('utf-8')).hexdigest()
+
+def _load_persisted_count(table, where, args, ttl):
+	d = db.select_one('select `value`, `updated_at` from `%s` where `name`=?' % _COUNTER_TABLE, _counter_name(table, where, args))
+	if d and d.updated_at + ttl > time.time():
+		return d.value
+	return None
+
+def _save_persisted_count(table, where, args, count):
+	db.upsert(_COUNTER_TABLE, ['name'], name=_counter_name(table, where, args), table_name=table, where_clause=where, value=count, updated_at=time.time())
+
+def _invalidate_persisted_counts(table):
+	db.update('delete from `%s` where `table_name`=?' % _COUNTER_TABLE, table)
+
+def _adjust_persisted_counts(model, delta):
+	'''
+	Apply delta to every persisted count of the model's table that the row matches.
+	The where clauses are read from the counter table, so counts saved by other
+	processes are adjusted too; counts that cannot be adjusted are deleted.
+	'''
+	table, names = model.__table__, []
+	for d in db.select('select distinct `where_clause` from `%s` where `table_name`=?' % _COUNTER_TABLE, table):
+		cols = _parse_simple_where(d.where_clause)
+		if cols is None or [c for c in cols if not c in model]:
+			db.update('delete from `%s` where `table_name`=? and `where_clause`=?' % _COUNTER_TABLE, table, d.where_clause)
+		else:
+			names.append(_counter_name(table, d.where_clause, [model[c] for c in cols]))
+	if names:
+		db.update('update `%s` set `value`=`value`+? where `name` in (%s)' % (_COUNTER_TABLE, ','.join(['?'] * len(names))), delta, *names)
+
+# find_page() offsets beyond which only primary keys are selected at the offset:
+_DEFERRED_OFFSET = 1000
+
+_RE_LIMIT = re.compile(r'\s+limit\s+.*$', re.IGNORECASE | re.DOTALL)
+_RE_ORDER_BY = re.compile(r'(?:^|\s+)order\s+by\s+', re.IGNORECASE)
+_RE_TERM = re.compile(r'^\(?\s*`?(\w+)`?\s*(=|<=|>=|<>|!=|<|>|in\b|between\b|like\b|is\b)', re.IGNORECASE)
+
+def _analyze_where(where):
+	'''
+	Return (equality columns, trailing columns) of the index that serves a where
+	clause, or None if no single index can serve it.
+	'''
+	where = _RE_LIMIT.sub('', ' ' + where.strip())
+	parts = _RE_ORDER_BY.split(where, 1)
+	cond = re.sub(r'(?i)^\s*where\s+', '', parts[0]).strip()
+	if re.search(r'(?i)\sor\s', cond):
+		return None
+	eq, ranges = [], []
+	for term in re.split(r'(?i)\s+and\s+', cond):
+		m = _RE_TERM.match(term.strip())
+		if not m:
+			# e.g. the upper bound of 'between ? and ?':
+			continue
+		col, op = m.group(1), m.group(2).lower()
+		if op in ('=', 'in', 'is'):
+			eq.append(col)
+		elif op in ('<', '>', '<=', '>=', 'between', 'like'):
+			ranges.append(col)
+	if ranges:
+		return eq, [ranges[0]]
+	order = []
+	if len(parts) > 1:
+		for c in parts[1].split(','):
+			col = re.sub(r'(?i)\s+(asc|desc)$', '', c.strip()).strip('`')
+			if not col in eq:
+				order.append(col)
+	if not eq and not order:
+		return None
+	return eq, order
+
+def _index_for_where(where):
+	'''
+	Return the index columns that serve a where clause: columns compared with
+	'=' or 'in' first, then either one range column or the order by columns.
+	Return None if a single index cannot serve the clause.
+
+	>>> _index_for_where('where blog_id=? order by created_at desc limit 10000')
+	('blog_id', 'created_at')
+	>>> _index_for_where('order by created_at desc limit ?,?')
+	('created_at',)
+	>>> _index_for_where('where `email`=?')
+	('email',)
+	>>> _index_for_where('where user_id=? and created_at>? order by name')
+	('user_id', 'created_at')
+	>>> _index_for_where('where name=? or email=?')
+	'''
+	r = _analyze_where(where)
+	if r is None:
+		return None
+	return tuple(r[0] + r[1])
+
+def _index_covers(index_cols, unique, where):
+	eq, tail = _analyze_where(where)
+	if unique and set(index_cols) <= set(eq):
+		# at most one row matches:
+		return True
+	n = len(eq)
+	if len(index_cols) < n + len(tail):
+		return False
+	return set(index_cols[:n])==set(eq) and list(index_cols[n:n + len(tail)])==tail
+
+def _live_indexes(table):
+	'''
+	Return {index name: (unique, [columns])} of table in the connected database.
+	'''
+	d = {}
+	for r in db.select('select `index_name` as `name`, `non_unique`, `column_name` as `col` from information_schema.statistics where table_schema=database() and table_name=? order by `index_name`, `seq_in_index`', table):
+		d.setdefault(r.name, (not r.non_unique, []))[1].append(r.col)
+	return d
+
+def index_diff(model, wheres=()):
+	'''
+	Compare the live indexes of a model's table with the indexes declared on the
+	model and with the indexes needed by the given where clauses (the query
+	shapes passed to find_by(), count_by()...). Return the 'create index'
+	statements for everything that is missing.
+	'''
+	table = model.__table__
+	have = _live_indexes(table).values()
+	statements = []
+	def _create(name, unique, cols):
+		statements.append('create %sindex `%s` on `%s` (%s);' % ('unique ' if unique else '', name, table, ','.join(['`%s`' % c for c in cols])))
+		have.append((unique, list(cols)))
+	for name, unique, cols in _index_specs(model.__mappings__, model.__indexes__):
+		if not [L for u, L in have if L==list(cols)]:
+			_create(name, unique, cols)
+	for where in wheres:
+		cols = _index_for_where(where)
+		if not cols:
+			continue
+		unknown = [c for c in cols if not c in model.__mappings__]
+		if unknown:
+			logging.warning('Skip query on %s with unknown columns %s: %s' % (table, unknown, where))
+			continue
+		if not [L for u, L in have if _index_covers(L, u, where)]:
+			_create('idx_%s' % '_'.join(cols), False, cols)
+	return statements
+
+# model class -> [fn(op, model, pk, changed_fields), ...]
+_listeners = {}
+
+def migrate_compressed(model):
+	'''
+	Rewrite the rows of model whose CompressedTextField columns still hold plain
+	text, after the columns were changed to blobs ('alter table ... modify ...
+	mediumblob' keeps the utf-8 bytes). The table stays online: rows are read in
+	primary key chunks and each value is only replaced if it has not changed
+	meanwhile. Return the number of values rewritten.
+	'''
+	pk = model.__primary_key__.name
+	n = 0
+	for f in model.__mappings__.itervalues():
+		if not isinstance(f, CompressedTextField):
+			continue
+		where = "where substr(`%s`, 1, 1) <> x'00'" % f.name
+		for cond, args, pks in model._pk_chunks(where, []):
+			for d in db.select('select `%s`, `%s` from `%s` where %s' % (pk, f.name, model.__table__, cond), *args):
+				v = d[f.name]
+				n = n + db.update('update `%s` set `%s`=? where `%s`=? and `%s`=?' % (model.__table__, f.name, pk, f.name), f.to_sql(f.from_sql(v)), d[pk], v)
+			logging.info('%s.%s: %s values compressed.' % (model.__name__, f.name, n))
+	return n
+
+def listen(model, fn):
+	'''
+	Register fn(op, model, pk, changed_fields) to be called after a row of the
+	model class has been inserted, updated or deleted and the enclosing
+	transaction has committed. op is 'insert', 'update' or 'delete', model is
+	the model class, pk the primary key of the row and changed_fields the list
+	of written field names; for update() only the fields whose values differ
+	from the loaded ones. Events of rolled back transactions are dropped.
+	'''
+	_listeners.setdefault(model, []).append(fn)
+
+def on_change(*models):
+	'''
+	An @on_change decorator that registers a listener for the given model classes.
+
+	@on_change(Blog, Comment)
+	def invalidate(op, model, pk, changed_fields):
+		pass
+	'''
+	def _decorator(func):
+		for model in models:
+			listen(model, func)
+		return func
+	return _decorator
+
+def _emit(model, op, pk, changed_fields, instance=None):
+	'''
+	Queue the change events of a row for after commit, and write an inserted
+	instance through to the entity cache or evict the cached row. Updated rows
+	are evicted, as update() does not write fields that are not updatable and
+	the instance may hold values the row does not have.
+	'''
+	cache = model.__entity_cache__
+	if cache:
+		if instance is not None and op=='insert' and not [k for k in model.__mappings__ if not k in instance]:
+			snapshot = instance.freeze()
+			db.after_commit(lambda: cache.put(pk, snapshot))
+		else:
+			db.after_commit(lambda: cache.evict(pk))
+	fns = _listeners.get(model)
+	if fns:
+		def _fire():
+			for fn in fns:
+				try:
+					fn(op, model, pk, changed_fields)
+				except Exception:
+					logging.exception('change listener failed.')
+		db.after_commit(_fire)
+
+_window = None
+
+def _window_functions():
+	'''
+	Return True if the server supports window functions (MySQL 8.0, MariaDB 10.2).
+	Checked once per process.
+	'''
+	global _window
+	if _window is None:
+		names, row = db.select_one_row('select version()')
+		m = re.match(r'(\d+)\.(\d+)', row[0])
+		version = (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+		_window = version >= ((10, 2) if 'mariadb' in row[0].lower() else (8, 0))
+	return _window
+
+def _copy(model, cls):
+	m = dict.__new__(cls)
+	dict.update(m, model)
+	loaded = model.__dict__.get('_loaded')
+	if loaded is not None:
+		m.__dict__['_loaded'] = loaded
+	return m
+
+class _FrozenModel(object):
+	'''
+	Mixin of the classes of immutable snapshots returned by Model.freeze().
+	'''
+	def _frozen(self, *args, **kw):
+		raise TypeError('%s is a frozen snapshot, use thaw() or replace() for a mutable copy.' % self.__thawed__.__name__)
+
+	__setattr__ = __setitem__ = __delattr__ = __delitem__ = _frozen
+	clear = pop = popitem = setdefault = _frozen
+	insert = update = upsert = _frozen
+
+class _EntityCache(object):
+	'''
+	Process-wide LRU cache of frozen model snapshots by primary key, enabled per model by:
+
+	class User(Model):
+		__cache__ = dict(ttl=300, max_entries=10000)
+
+	Model.get() and Model.get_many() read through it, and the writes of the ORM
+	update or evict the cached rows after commit.
+
+	>>> c = _EntityCache(ttl=300, max_entries=2)
+	>>> c.put(1, 'a')
+	>>> c.put(2, 'b')
+	>>> c.get(1)
+	'a'
+	>>> c.put(3, 'c')
+	>>> c.get(2) is None
+	True
+	>>> c.get(3)
+	'c'
+	>>> c.evict(1)
+	>>> c.ttl = -1
+	>>> c.put(4, 'd')
+	>>> c.get(4) is None
+	True
+	>>> sorted(c.stats().items())
+	[('entries', 1), ('evictions', 3), ('hits', 2), ('misses', 2)]
+	'''
+	def __init__(self, ttl=300, max_entries=1000):
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._lock = threading.Lock()
+		# pk -> (model, expires), least recently used first:
+		self._entries = collections.OrderedDict()
+
+	def get(self, pk):
+		with self._lock:
+			e = self._entries.pop(pk, None)
+			if e is None:
+				self.misses = self.misses + 1
+				return None
+			if e[1] < time.time():
+				self.misses = self.misses + 1
+				self.evictions = self.evictions + 1
+				return None
+			self._entries[pk] = e
+			self.hits = self.hits + 1
+			return e[0]
+
+	def put(self, pk, model):
+		with self._lock:
+			self._entries.pop(pk, None)
+			self._entries[pk] = (model, time.time() + self.ttl)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+				self.evictions = self.evictions + 1
+
+	def evict(self, pk):
+		with self._lock:
+			if self._entries.pop(pk, None) is not None:
+				self.evictions = self.evictions + 1
+
+	def stats(self):
+		return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self._entries))
+
+class _Batch(object):
+
+	def __init__(self):
+		self.pks = []
+		self.rows = {}
+		self.names = None
+		self.error = None
+		self.full = threading.Event()
+		self.done = threading.Event()
+
+class _BatchLoader(object):
+	'''
+	Coalesce the primary key lookups of concurrent threads into one query,
+	enabled per model by:
+
+	class User(Model):
+		__batch_get__ = dict(window=0.0005, max_batch=100)
+
+	The first thread looking up a key opens a batch and waits up to window
+	seconds, or until max_batch keys are collected, then selects all keys of
+	the batch by one 'in (...)' query on its connection and wakes the others.
+
+	>>> class BatchTag(Model):
+	... 	__batch_get__ = dict(window=5.0, max_batch=3)
+	... 	id = IntegerField(primary_key=True)
+	... 	name = StringField()
+	>>> queries = []
+	>>> def select_rows(sql, *args):
+	... 	queries.append(sorted(args))
+	... 	if 0 in args:
+	... 		raise IOError('connection lost')
+	... 	return ['id', 'name'], [(pk, u'tag%d' % pk) for pk in args if pk < 10]
+	>>> def load_all(pks):
+	... 	results = {}
+	... 	def run(pk):
+	... 		try:
+	... 			results[pk] = BatchTag.__batch_loader__.load(pk)[1]
+	... 		except IOError, e:
+	... 			results[pk] = e
+	... 	threads = [threading.Thread(target=run, args=(pk,)) for pk in pks]
+	... 	for t in threads: t.start()
+	... 	for t in threads: t.join()
+	... 	return sorted(results.items())
+	>>> _select_rows, db.select_rows = db.select_rows, select_rows
+	>>> load_all([1, 2, 99])
+	[(1, (1, u'tag1')), (2, (2, u'tag2')), (99, None)]
+	>>> queries
+	[[1, 2, 99]]
+	>>> sorted(BatchTag.batch_stats().items())
+	[('keys_per_query', 3.0), ('lookups', 3), ('queries', 1)]
+
+	A batch is cut at max_batch keys, and a failed query raises in every thread:
+
+	>>> queries = []
+	>>> len(load_all(range(4, 10)))
+	6
+	>>> [len(q) for q in queries]
+	[3, 3]
+	>>> queries = []
+	>>> load_all([0, 1, 2])
+	[(0, IOError('connection lost',)), (1, IOError('connection lost',)), (2, IOError('connection lost',))]
+	>>> len(queries)
+	1
+	>>> db.select_rows = _select_rows
+	'''
+	def __init__(self, model, window=0.0005, max_batch=100):
+		self.model = model
+		self.window = window
+		self.max_batch = max_batch
+		self.lookups = 0
+		self.queries = 0
+		self._lock = threading.Lock()
+		self._batch = None
+
+	def load(self, pk):
+		'''
+		Return (names, row) of the primary key, row is None if not found.
+		'''
+		with self._lock:
+			self.lookups = self.lookups + 1
+			batch = self._batch
+			leader = batch is None
+			if leader:
+				batch = self._batch = _Batch()
+			if not pk in batch.pks:
+				batch.pks.append(pk)
+			if len(batch.pks) >= self.max_batch:
+				self._batch = None
+				batch.full.set()
+		if not leader:
+			batch.done.wait()
+		else:
+			batch.full.wait(self.window)
+			with self._lock:
+				if self._batch is batch:
+					self._batch = None
+				self.queries = self.queries + 1
+			try:
+				model = self.model
+				pk_name = model.__primary_key__.name
+				names, rows = db.select_rows('select * from `%s` where `%s` in (%s)' % (model.__table__, pk_name, ','.join(['?'] * len(batch.pks))), *batch.pks)
+				n = names.index(pk_name)
+				batch.names = names
+				batch.rows = dict([(row[n], row) for row in rows])
+			except Exception, e:
+				batch.error = e
+			batch.done.set()
+		if batch.error is not None:
+			raise batch.error
+		return batch.names, batch.rows.get(pk)
+
+	def stats(self):
+		return dict(lookups=self.lookups, queries=self.queries, keys_per_query=float(self.lookups) / self.queries if self.queries else 0.0)
+
 class ModelMetaclass(type):
 	'''
 	Metaclass for model object.
@@ -128,13 +859,14 @@ class ModelMetaclass(type):
 		if not hasattr(cls, 'subclasses'):
 			cls.subclasses = {}
 		if not name in cls.subclasses:
-			cls.subclasses[name] = name
+			cls.subclasses[name] = None
 		else:
 			logging.warning('Redefine class: %s' % name)
 
 		logging.info('Scan ORMapping %s...' % name)
 		mappings = dict()
 		primary_key = None
+		version = None
 		for k, v in attrs.iteritems():
 			if isinstance(v, Field):
 				if not v.name:
@@ -151,21 +883,44 @@ class ModelMetaclass(type):
 						logging.warning('NOTE: change primary key to non-nullable.')
 						v.nullable = False
 					primary_key = v
+				if isinstance(v, VersionField):
+					if version:
+						raise TypeError('Cannot define more than 1 version field in class: %s' % name)
+					version = v
 				mappings[k] = v
-			# check exist of primary key:
-			if not primary_key:
-				raise TypeError('Primary key not defined in class: %s' % name)
-			for k in mappings.iterkeys():
-				attrs.pop(k)
-			if not '__table__' in attrs:
-				attrs['__table__'] = name.lower()
-			attrs['__mappings__'] = mappings
-			attrs['__primary_key__'] = primary_key
-			attrs['__sql__'] =  lambda self: __gen_sql(attrs['__table__'], mappings)
-			for trigger in _triggers:
-				if not trigger in attrs:
-					atts[trigger] = None
-			return type.__new__(cls, name, bases, attrs)
+		# check exist of primary key:
+		if not primary_key:
+			raise TypeError('Primary key not defined in class: %s' % name)
+		for k in mappings.iterkeys():
+			attrs.pop(k)
+		if not '__table__' in attrs:
+			attrs['__table__'] = name.lower()
+		# check composite indexes:
+		indexes = [tuple(cols) for cols in attrs.get('__indexes__', [])]
+		for cols in indexes:
+			for col in cols:
+				if not col in mappings:
+					raise TypeError('Index column "%s" is not a field of class: %s' % (col, name))
+		attrs['__mappings__'] = mappings
+		attrs['__primary_key__'] = primary_key
+		attrs['__version__'] = version
+		attrs['__entity_cache__'] = _EntityCache(**attrs['__cache__']) if attrs.get('__cache__') else None
+		attrs['__batch_loader__'] = None
+		attrs['__indexes__'] = indexes
+		attrs['__sql__'] =  lambda self: _gen_sql(attrs['__table__'], mappings, indexes)
+		for trigger in _triggers:
+			if not trigger in attrs:
+				attrs[trigger] = None
+		model = type.__new__(cls, name, bases, attrs)
+		model.__thawed__ = model
+		if attrs.get('__batch_get__'):
+			model.__batch_loader__ = _BatchLoader(model, **attrs['__batch_get__'])
+		model.__frozen__ = type.__new__(cls, 'Frozen%s' % name, (_FrozenModel, model), dict(__module__=model.__module__))
+		cls.subclasses[name] = model
+		for f in mappings.itervalues():
+			if isinstance(f, CounterField):
+				_counter_fields.setdefault(f.model, []).append((model, f))
+		return model
 
 class Model(dict):
 	'''
@@ -216,25 +971,143 @@ class Model(dict):
 	'''
 	__metaclass__ = ModelMetaclass
 
+	__count_cache__ = None
+
+	__cache__ = None
+	__entity_cache__ = None
+
+	__batch_get__ = None
+	__batch_loader__ = None
+
+	# rows per statement of update_where() and delete_where():
+	__batch_size__ = 1000
+
 	def __init__(self, **kw):
 		super(Model, self).__init__(**kw)
 	
 	def __getattr__(self, key):
 		try:
-			return self[key]
+			v = self[key]
 		except KeyError:
-			raise AttributerError(r"'Dict' object has no attribute '%s'" % key)
+			raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
+		return v.text if isinstance(v, LazyText) else v
 	
 	def __setattr__(self, key, value):
 		self[key] = value
 
+	def freeze(self):
+		'''
+		Return an immutable snapshot of the model. Snapshots can be cached and
+		shared between threads without copying; any change raises TypeError.
+
+		>>> class Tag(Model):
+		... 	id = IntegerField(primary_key=True)
+		... 	name = StringField()
+		>>> t = Tag(id=1, name=u'python').freeze()
+		>>> t.name, isinstance(t, Tag), t.freeze() is t
+		(u'python', True, True)
+		>>> t.name = u'java'
+		Traceback (most recent call last):
+		  ...
+		TypeError: Tag is a frozen snapshot, use thaw() or replace() for a mutable copy.
+		>>> t.replace(name=u'java').name, t.thaw().__class__.__name__
+		(u'java', 'Tag')
+		'''
+		if isinstance(self, _FrozenModel):
+			return self
+		return _copy(self, self.__frozen__)
+
+	def thaw(self):
+		'''
+		Return a mutable copy of the model or snapshot.
+		'''
+		return _copy(self, self.__thawed__)
+
+	def replace(self, **kw):
+		'''
+		Return a mutable copy of the model or snapshot with the given fields changed.
+		'''
+		m = self.thaw()
+		for k, v in kw.iteritems():
+			m[k] = v
+		return m
+
+	@classmethod
+	def get(cls, pk, frozen=False):
+		'''
+		Get by primary key. Models with __cache__ are read through the entity cache,
+		which holds frozen snapshots. With frozen=True the shared snapshot is
+		returned as is, otherwise a private mutable copy.
+		'''
+		in_transaction = db.in_transaction()
+		# inside a transaction a cached row may predate the transaction's own writes:
+		cache = None if in_transaction else cls.__entity_cache__
+		if cache:
+			m = cache.get(pk)
+			if m is not None:
+				return m if frozen else m.thaw()
+		loader = cls.__batch_loader__
+		if loader and not in_transaction:
+			names, row = loader.load(pk)
+		else:
+			names, row = db.select_one_row('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
+		if not row:
+			return None
+		m = _loader(cls, names)(row)
+		if frozen or cache:
+			snapshot = m.freeze()
+			if cache:
+				cache.put(pk, snapshot)
+			if frozen:
+				return snapshot
+		return m
+
+	@classmethod
+	def get_many(cls, pks, frozen=False):
+		'''
+		Get by a list of primary keys with one query, return dict of pk: model
+		for the rows found. Uses the entity cache like get().
+		'''
+		cache = None if db.in_transaction() else cls.__entity_cache__
+		pk = cls.__primary_key__.name
+		d = {}
+		missing = []
+		for k in pks:
+			m = cache.get(k) if cache else None
+			if m is not None:
+				d[k] = m if frozen else m.thaw()
+			elif not k in missing:
+				missing.append(k)
+		if missing:
+			names, rows = db.select_rows('select * from `%s` where `%s` in (%s)' % (cls.__table__, pk, ','.join(['?'] * len(missing))), *missing)
+			load = _loader(cls, names)
+			n = names.index(pk)
+			for row in rows:
+				m = load(row)
+				if frozen or cache:
+					snapshot = m.freeze()
+					if cache:
+						cache.put(row[n], snapshot)
+					if frozen:
+						m = snapshot
+				d[row[n]] = m
+		return d
+
 	@classmethod
-	def get(cls, pk):
+	def cache_stats(cls):
 		'''
-		Get by primary key.
+		Return dict(hits, misses, evictions, entries) of the entity cache, or None if not enabled.
 		'''
-		d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-		return cls(**d) if d else None
+		cache = cls.__entity_cache__
+		return cache.stats() if cache else None
+
+	@classmethod
+	def batch_stats(cls):
+		'''
+		Return dict(lookups, queries, keys_per_query) of the batch loader, or None if not enabled.
+		'''
+		loader = cls.__batch_loader__
+		return loader.stats() if loader else None
 
 	@classmethod
 	def find_first(cls, where, *args):
@@ -242,75 +1115,555 @@ class Model(dict):
 		Find by where clause and return one result. if multiple results found,
 		only the first one returned. If no result found, return None.
 		'''
-		d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-		return cls(**d) if d else None
+		names, row = db.select_one_row('select * from %s %s' % (cls.__table__, where), *args)
+		return _loader(cls, names)(row) if row else None
 
 	@classmethod
 	def find_all(cls, *args):
 		'''
 		Find all and return list.
 		'''
-		L = db.select('select * from `%s`' % cls.__table__)
-		return [cls(**d) for d in L]
+		names, rows = db.select_rows('select * from `%s`' % cls.__table__)
+		return map(_loader(cls, names), rows)
 
 	@classmethod
-	def find_by(cls, where, *args):
+	def find_by(cls, where, *args, **kw):
 		'''
 		Find by where clause and return list.
+
+		Pass deferred=True for 'limit ?,?' queries on deep pages: only primary
+		keys are selected at the offset, which can be answered from the index,
+		then the full rows are fetched for that small set of keys.
+
+		Blog.find_by('order by created_at desc limit ?,?', 9000, 10, deferred=True)
+		'''
+		deferred = kw.pop('deferred', False)
+		if kw:
+			raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw.keys()))
+		if deferred:
+			return cls._find_by_deferred(where, *args)
+		names, rows = db.select_rows('select * from `%s` %s' % (cls.__table__, where), *args)
+		return map(_loader(cls, names), rows)
+
+	@classmethod
+	@db.with_connection
+	def _find_by_deferred(cls, where, *args):
+		pk = cls.__primary_key__.name
+		ids = [d[pk] for d in db.select('select `%s` from `%s` %s' % (pk, cls.__table__, where), *args)]
+		return cls._find_by_pks(ids)
+
+	@classmethod
+	def _find_by_pks(cls, ids):
+		'''
+		Return the rows of the primary keys in ids, in the order of ids.
+		'''
+		if not ids:
+			return []
+		pk = cls.__primary_key__.name
+		names, rows = db.select_rows('select * from `%s` where `%s` in (%s)' % (cls.__table__, pk, ','.join(['?'] * len(ids))), *ids)
+		load = _loader(cls, names)
+		n = names.index(pk)
+		models = dict([(r[n], load(r)) for r in rows])
+		# keep the order of the first query:
+		return [models[i] for i in ids if i in models]
+
+	@classmethod
+	@db.with_connection
+	def find_page(cls, where, args=(), page_index=1, page_size=15):
 		'''
-		L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-		return [cls(**d) for d in L]
+		Find one page of rows by where clause, return (list, Page). The where
+		clause must not contain a limit:
+
+		blogs, page = Blog.find_page('order by created_at desc', (), 3)
+
+		If the count cache holds a fresh total the page is one plain 'limit ?,?'
+		query. Otherwise, on servers with window functions, the rows and the
+		total come from one statement with 'count(*) over()'; elsewhere the total
+		is counted first. Pages past _DEFERRED_OFFSET rows select only primary
+		keys at the offset and fetch the full rows by them, like
+		find_by(deferred=True).
+		'''
+		args = tuple(args)
+		count_where = _RE_ORDER_BY.split(where, 1)[0].strip()
+		offset = page_size * (max(page_index, 1) - 1)
+		deferred = offset > _DEFERRED_OFFSET
+		total = cls._cached_count(count_where, args)
+		if total is None and _window_functions():
+			rows = cls._find_page_with_total(where, args + (offset, page_size), deferred)
+			if rows:
+				total = rows[0][1]
+				cls._cache_count(count_where, args, total)
+				page = Page(total, page_index, page_size)
+				return ([m for m, n in rows] if page.limit else []), page
+			# no rows at the offset, count to tell an empty table from a page out of range:
+		if total is None:
+			total = cls._count(count_where, args)
+		page = Page(total, page_index, page_size)
+		if not page.limit:
+			return [], page
+		return cls.find_by('%s limit ?,?' % where, *(args + (page.offset, page.limit)), deferred=deferred), page
+
+	@classmethod
+	def _find_page_with_total(cls, where, args, deferred):
+		'''
+		Return [(model, total)] of a 'limit ?,?' page with the total of the where
+		clause by 'count(*) over()'.
+		'''
+		if deferred:
+			pk = cls.__primary_key__.name
+			rows = db.select('select `%s`, count(*) over() as `_total` from `%s` %s limit ?,?' % (pk, cls.__table__, where), *args)
+			models = cls._find_by_pks([d[pk] for d in rows])
+			return [(m, rows[0]._total) for m in models]
+		names, rows = db.select_rows('select *, count(*) over() as `_total` from `%s` %s limit ?,?' % (cls.__table__, where), *args)
+		load = _loader(cls, names[:-1])
+		return [(load(r[:-1]), r[-1]) for r in rows]
 
 	@classmethod
 	def count_all(cls):
 		'''
 		Find by 'select count(pk) from talbe' and return interger.
 		'''
-		return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls._table__))
+		return cls._count('', args=())
 
 	@classmethod
 	def count_by(cls, where, *args):
 		'''
 		Find by 'select count(pk) from talbe where ...' and return int.
 		'''
-		return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where))
+		return cls._count(where, args)
+
+	@classmethod
+	def recount(cls, where='', *args):
+		'''
+		Count by 'select count(pk) ...' bypassing the count cache, and refresh the cached value.
+		'''
+		return cls._count(where, args, recount=True)
+
+	@classmethod
+	def _count(cls, where, args, recount=False):
+		'''
+		Count rows, using the count cache if __count_cache__ is defined on the model:
+
+		class Blog(Model):
+			__count_cache__ = dict(ttl=60, persist=False)
+
+		ttl is the number of seconds a count is trusted. Counts of 'where col=? and ...'
+		clauses are maintained by insert() and delete(); other where clauses are
+		recounted after any write to the table. With persist=True the counts are
+		kept in the _row_counts table instead of process memory, and adjusted in
+		the writing transaction, so that all worker processes agree.
+		'''
+		if not recount:
+			n = cls._cached_count(where, args)
+			if n is not None:
+				return n
+		n = db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+		cls._cache_count(where, args, n)
+		return n
+
+	@classmethod
+	def _cached_count(cls, where, args):
+		opts = cls.__count_cache__
+		if not opts:
+			return None
+		if opts.get('persist', False):
+			return _load_persisted_count(cls.__table__, where, args, opts.get('ttl', 60))
+		return _count_cache.get(cls.__table__, where, args)
+
+	@classmethod
+	def _cache_count(cls, where, args, n):
+		opts = cls.__count_cache__
+		# a count inside a transaction includes its own uncommitted rows, which
+		# are adjusted again by _count_changed(), so it is not cached:
+		if not opts or db.in_transaction():
+			return
+		if opts.get('persist', False):
+			_save_persisted_count(cls.__table__, where, args, n)
+		else:
+			_count_cache.put(cls.__table__, where, args, n, opts.get('ttl', 60))
+
+	@classmethod
+	def _invalidate_counts(cls):
+		if cls.__count_cache__.get('persist', False):
+			_invalidate_persisted_counts(cls.__table__)
+		else:
+			_count_cache.invalidate(cls.__table__)
+
+	def _count_changed(self, delta):
+		opts = self.__count_cache__
+		if not opts:
+			return
+		if opts.get('persist', False):
+			# in the same transaction, so the count changes exactly when the row does:
+			_adjust_persisted_counts(self, delta)
+			return
+		# adjust once the transaction has committed, values may change until then:
+		table, values = self.__table__, dict(self)
+		db.after_commit(lambda: _count_cache.adjust(table, values, delta))
 
 	def update(self):
+		'''
+		Update all updatable fields by primary key and return self.
+
+		If the model has a VersionField the update is a compare-and-swap: it runs
+		'update ... where pk=? and version=?' and increments the version. If no
+		row matches, the row was changed or deleted since this model was loaded,
+		and ConflictError is raised instead of overwriting the other change.
+
+		class Blog(Model):
+			...
+			version = VersionField()
+		'''
 		self.pre_update and self.pre_update()
+		changed = self._changed_names()
 		L = []
 		args = []
-		for k, v in self.__mappings__.interitems():
+		for k, v in self.__mappings__.iteritems():
 			if v.updatable:
-				if hasattr(self, k):
-					arg = getattr(self, k)
+				if k in self:
+					arg = self[k]
 				else:
 					arg = v.default
 					setattr(self, k, arg)
 				L.append('`%s`=?' % k)
-				args.append(arg)
+				args.append(v.to_sql(arg))
 		pk = self.__primary_key__.name
 		args.append(getattr(self, pk),)
-		db.update('delete from `%s` where `%s` =?' % (self.__table__, pk), *args)
+		version = self.__version__
+		if version is None:
+			db.update('update `%s` set %s where `%s`=?' % (self.__table__, ','.join(L), pk), *args)
+			self._set_loaded()
+			_emit(self.__class__, 'update', getattr(self, pk), changed)
+			return self
+		current = getattr(self, version.name, 0)
+		L.append('`%s`=`%s`+1' % (version.name, version.name))
+		args.append(current)
+		if not db.update('update `%s` set %s where `%s`=? and `%s`=?' % (self.__table__, ','.join(L), pk, version.name), *args):
+			raise ConflictError('%s %s was changed by another update (version %s).' % (self.__class__.__name__, getattr(self, pk), current))
+		setattr(self, version.name, current + 1)
+		self._set_loaded()
+		_emit(self.__class__, 'update', getattr(self, pk), changed + [version.name])
 		return self
 
+	def _updatable_names(self):
+		return [v.name for v in self.__mappings__.itervalues() if v.updatable]
+
+	def _changed_names(self):
+		'''
+		Return the names of the updatable fields that differ from the values
+		loaded from the database, or all of them if the model was not loaded.
+
+		>>> class Tag(Model):
+		... 	id = IntegerField(primary_key=True)
+		... 	name = StringField()
+		... 	count = IntegerField()
+		>>> t = _loader(Tag, ['id', 'name', 'count'])((1, u'python', 3))
+		>>> t._changed_names()
+		[]
+		>>> t.name = u'java'
+		>>> t._changed_names()
+		['name']
+		>>> sorted(Tag(id=2, name=u'go', count=0)._changed_names())
+		['count', 'name']
+		'''
+		loaded = self.__dict__.get('_loaded')
+		if loaded is None:
+			return self._updatable_names()
+		values = dict(zip(*loaded))
+		L = []
+		for v in self.__mappings__.itervalues():
+			if not v.updatable:
+				continue
+			current = dict.get(self, v.name)
+			# a compressed value still loaded as is cannot have changed:
+			if isinstance(current, LazyText):
+				continue
+			if not v.name in values or current!=values[v.name]:
+				L.append(v.name)
+		return L
+
+	def _set_loaded(self):
+		names = tuple(dict.keys(self))
+		self.__dict__['_loaded'] = (names, tuple([self[k] for k in names]))
+
+	@classmethod
+	def _pk_chunks(cls, where, args):
+		'''
+		Yield (condition, args, pks) for the rows matching where, in primary key
+		order and __batch_size__ rows at a time. The condition selects the same
+		rows by where and by the primary key range of the chunk.
+		'''
+		pk = cls.__primary_key__.name
+		cond = re.sub(r'(?i)^\s*where\s+', '', where.strip())
+		cond = cond and '(%s) and ' % cond
+		last = None
+		while True:
+			if last is None:
+				L = db.select('select `%s` from `%s` where %s1=1 order by `%s` limit ?' % (pk, cls.__table__, cond, pk), *(list(args) + [cls.__batch_size__]))
+			else:
+				L = db.select('select `%s` from `%s` where %s`%s`>? order by `%s` limit ?' % (pk, cls.__table__, cond, pk, pk), *(list(args) + [last, cls.__batch_size__]))
+			if not L:
+				return
+			pks = [d[pk] for d in L]
+			yield '%s`%s` between ? and ?' % (cond, pk), list(args) + [pks[0], pks[-1]], pks
+			last = pks[-1]
+
+	@classmethod
+	def parallel_scan(cls, fn, workers=4, chunk_rows=1000, where='', args=()):
+		'''
+		Call fn(model) for every row matching the where clause, scanning primary
+		key ranges of chunk_rows rows in parallel, each worker thread on its own
+		connection. fn is called from the worker threads and must be thread-safe:
+
+		Blog.parallel_scan(reindex, workers=8, chunk_rows=500)
+
+		The range boundaries are found by the calling thread while the workers
+		already scan the first ranges. The first exception raised by fn stops the
+		scan and is raised again. Progress is logged after every range. Return
+		dict(rows, ranges, seconds, rows_per_second).
+		'''
+		pk = cls.__primary_key__.name
+		cond = re.sub(r'(?i)^\s*where\s+', '', where.strip())
+		cond = cond and '(%s) and ' % cond
+		ranges = Queue.Queue(workers * 2)
+		lock = threading.Lock()
+		stats = dict(rows=0, ranges=0)
+		errors = []
+		start = time.time()
+
+		def _scan():
+			with db.connection():
+				while True:
+					r = ranges.get()
+					if r is None:
+						return
+					if errors:
+						continue
+					lo, hi = r
+					L = []
+					range_args = list(args)
+					if lo is not None:
+						L.append('`%s`>?' % pk)
+						range_args.append(lo)
+					if hi is not None:
+						L.append('`%s`<=?' % pk)
+						range_args.append(hi)
+					try:
+						names, rows = db.select_rows('select * from `%s` where %s%s order by `%s`' % (cls.__table__, cond, ' and '.join(L) or '1=1', pk), *range_args)
+						load = _loader(cls, names)
+						for row in rows:
+							fn(load(row))
+					except Exception, e:
+						logging.exception('parallel scan of %s failed.' % cls.__table__)
+						errors.append(e)
+						continue
+					with lock:
+						stats['rows'] = stats['rows'] + len(rows)
+						stats['ranges'] = stats['ranges'] + 1
+						t = time.time() - start
+						logging.info('%s: scanned %s rows in %s ranges, %.0f rows/s.' % (cls.__table__, stats['rows'], stats['ranges'], stats['rows'] / t if t else 0))
+
+		threads = [threading.Thread(target=_scan) for i in range(workers)]
+		for t in threads:
+			t.daemon = True
+			t.start()
+		try:
+			lo = None
+			while not errors:
+				if lo is None:
+					L = db.select('select `%s` from `%s` where %s1=1 order by `%s` limit ?,1' % (pk, cls.__table__, cond, pk), *(list(args) + [chunk_rows - 1]))
+				else:
+					L = db.select('select `%s` from `%s` where %s`%s`>? order by `%s` limit ?,1' % (pk, cls.__table__, cond, pk, pk), *(list(args) + [lo, chunk_rows - 1]))
+				hi = L[0][pk] if L else None
+				ranges.put((lo, hi))
+				if hi is None:
+					break
+				lo = hi
+		finally:
+			for t in threads:
+				ranges.put(None)
+			for t in threads:
+				t.join()
+		if errors:
+			raise errors[0]
+		t = time.time() - start
+		return dict(rows=stats['rows'], ranges=stats['ranges'], seconds=t, rows_per_second=stats['rows'] / t if t else 0)
+
+	@classmethod
+	def _update_sets(cls, changes):
+		sets = []
+		values = []
+		for k, v in changes.iteritems():
+			f = cls.__mappings__.get(k)
+			if f is None:
+				raise ValueError('No such field: %s' % k)
+			if not f.updatable:
+				raise ValueError('Field is not updatable: %s' % k)
+			sets.append('`%s`=?' % f.name)
+			values.append(f.to_sql(v))
+		if cls.__version__:
+			sets.append('`%s`=`%s`+1' % (cls.__version__.name, cls.__version__.name))
+		return sets, values
+
+	@classmethod
+	def update_where(cls, where, args, **changes):
+		'''
+		Update all rows matching the where clause without loading them, e.g. to
+		rename a user in the denormalized columns of comments:
+
+		Comment.update_where('where user_id=?', [user.id], user_name=user.name)
+
+		Rows are updated in primary key ranges of __batch_size__ rows, each by one
+		statement, so locks are only held on a short range at a time. Only updatable
+		fields can be changed. If the model defines a classmethod
+		pre_update_where(cls, pks, changes) it is called before each chunk, and
+		may add changes, like pre_update() sets fields before update().
+		Return the number of rows updated.
+		'''
+		sets, values = cls._update_sets(changes)
+		n = 0
+		for cond, cond_args, pks in cls._pk_chunks(where, args):
+			if cls.pre_update_where:
+				cls.pre_update_where(pks, changes)
+				sets, values = cls._update_sets(changes)
+			n = n + db.update('update `%s` set %s where %s' % (cls.__table__, ', '.join(sets), cond), *(values + cond_args))
+			for pk in pks:
+				_emit(cls, 'update', pk, changes.keys())
+		if n and cls.__count_cache__:
+			cls._invalidate_counts()
+		return n
+
+	@classmethod
+	def delete_where(cls, where, args):
+		'''
+		Delete all rows matching the where clause without loading them:
+
+		Comment.delete_where('where blog_id=?', [blog.id])
+
+		Rows are deleted in primary key ranges of __batch_size__ rows, one
+		transaction per chunk, which also updates the counters of parent models.
+		If the model defines a classmethod pre_delete_where(cls, pks) it is called
+		before each chunk. Return the number of rows deleted.
+		'''
+		n = 0
+		for cond, cond_args, pks in cls._pk_chunks(where, args):
+			cls.pre_delete_where and cls.pre_delete_where(pks)
+			with db.transaction():
+				for parent, f in _counter_fields.get(cls.__name__, ()):
+					for d in db.select('select `%s` as fk, count(*) as n from `%s` where %s group by `%s`' % (f.foreign_key, cls.__table__, cond, f.foreign_key), *cond_args):
+						db.update('update `%s` set `%s`=`%s`-? where `%s`=?' % (parent.__table__, f.name, f.name, parent.__primary_key__.name), d.n, d.fk)
+						_emit(parent, 'update', d.fk, [f.name])
+				n = n + db.update('delete from `%s` where %s' % (cls.__table__, cond), *cond_args)
+				for pk in pks:
+					_emit(cls, 'delete', pk, [])
+		if n and cls.__count_cache__:
+			cls._invalidate_counts()
+		return n
+
+	@classmethod
+	def repair_counters(cls):
+		'''
+		Recompute all CounterField columns of this model, one grouped query per counter.
+		'''
+		pk = cls.__primary_key__.name
+		for f in cls.__mappings__.itervalues():
+			if isinstance(f, CounterField):
+				child = ModelMetaclass.subclasses[f.model]
+				db.update('update `%s` p left join (select `%s` as fk, count(*) as n from `%s` group by `%s`) c on c.fk=p.`%s` set p.`%s`=coalesce(c.n, 0)' % (cls.__table__, f.foreign_key, child.__table__, f.foreign_key, pk, f.name))
+
+	def _update_counters(self, delta):
+		for parent, f in _counter_fields.get(self.__class__.__name__, ()):
+			fk = dict.get(self, f.foreign_key)
+			if fk is not None:
+				db.update('update `%s` set `%s`=`%s`+? where `%s`=?' % (parent.__table__, f.name, f.name, parent.__primary_key__.name), delta, fk)
+				_emit(parent, 'update', fk, [f.name])
+
 	def delete(self):
 		self.pre_delete and self.pre_delete()
 		pk = self.__primary_key__.name 
 		args = (getattr(self, pk), )
-		db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+		fks = list(set([f.foreign_key for parent, f in _counter_fields.get(self.__class__.__name__, ())]))
+		with db.transaction():
+			if fks:
+				# the instance may lack the foreign keys, like Comment(id=x).delete():
+				d = db.select_one('select %s from `%s` where `%s`=?' % (', '.join(['`%s`' % c for c in fks]), self.__table__, pk), *args)
+				for c in (fks if d else ()):
+					self[c] = d[c]
+			r = db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+			if r:
+				self._update_counters(-1)
+				self._count_changed(-1)
+				_emit(self.__class__, 'delete', args[0], [])
 		return self
 
-	def insert(self):
-		self.pre_insert and self.pre_insert()
+	def _insert_params(self):
 		params = {}
 		for k, v in self.__mappings__.iteritems():
 			if v.insertable:
-				if not hasattr(self, k):
+				if not k in self:
 					setattr(self, k, v.default)
-				params[v.name] = getattr(self, k)
-		db.insert('%s' % self.__table__, **params)
+				params[v.name] = v.to_sql(self[k])
+		return params
+
+	def insert(self, ignore_duplicates=False):
+		'''
+		Insert and return self. With ignore_duplicates=True a row that duplicates
+		an existing primary or unique key is skipped, see db.insert_ignore(), and the
+		return value is True if the row was inserted or False if it was skipped:
+
+		if not user.insert(ignore_duplicates=True):
+			raise APIError('register:failed', 'email', 'Email is already in use.')
+		'''
+		self.pre_insert and self.pre_insert()
+		params = self._insert_params()
+		with db.transaction():
+			if ignore_duplicates:
+				r = db.insert_ignore('%s' % self.__table__, **params)
+			else:
+				r = db.insert('%s' % self.__table__, **params)
+			if r:
+				self._update_counters(1)
+				self._count_changed(1)
+				_emit(self.__class__, 'insert', getattr(self, self.__primary_key__.name), params.keys(), self)
+		if ignore_duplicates:
+			return r==1
 		return self
 
+	def upsert(self):
+		'''
+		Insert, or update the row with the same primary or unique key in the same
+		statement. Only updatable fields are written to an existing row. Return
+		True if a new row was inserted.
+		'''
+		self.pre_insert and self.pre_insert()
+		params = self._insert_params()
+		key_cols = [v.name for v in self.__mappings__.itervalues() if not v.updatable]
+		with db.transaction():
+			inserted = db.upsert(self.__table__, key_cols, **params)
+			if inserted:
+				self._update_counters(1)
+				self._count_changed(1)
+				_emit(self.__class__, 'insert', getattr(self, self.__primary_key__.name), params.keys(), self)
+			else:
+				# the conflict may be on a unique key, so the updated row has its own pk:
+				pk = self._conflicting_pk(params)
+				if pk is not None:
+					_emit(self.__class__, 'update', pk, [c for c in params if not c in key_cols])
+		return inserted
+
+	def _conflicting_pk(self, params):
+		'''
+		Return the pk of the only row having the primary key or a unique key of
+		params, or None if there is no such row or more than one.
+		'''
+		cols = [self.__primary_key__.name] + [v.name for v in self.__mappings__.itervalues() if v.unique and not v.primary_key]
+		cols = [c for c in cols if c in params]
+		rows = db.select('select `%s` from `%s` where %s limit 2' % (self.__primary_key__.name, self.__table__, ' or '.join(['`%s`=?' % c for c in cols])), *[params[c] for c in cols])
+		if len(rows)!=1:
+			logging.warning('Drop change event of %s upsert: %d rows match its keys.' % (self.__class__.__name__, len(rows)))
+			return None
+		return rows[0][self.__primary_key__.name]
+
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.DEBUG)
 	db.create_engine('www-data', 'www-data', 'test')
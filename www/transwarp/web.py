@@ -7,11 +7,11 @@ A simple, lightweight, WSGI-compatible web framework.
 
 __author__ = 'This is Test!'
 
-import types, os, re, cgi, sys, time, datetime, functools, mimetypes, threading, logging, urllib, traceback
+import types, os, re, cgi, sys, json, time, zlib, hashlib, datetime, collections, email.utils, tempfile, urlparse, functools, mimetypes, threading, logging, urllib, traceback
 
 try:
 	from cStringIO import StringIO
-except ImprotError:
+except ImportError:
 	from StringIO import StringIO
 
 # thread local object for storing request and respones;
@@ -41,7 +41,7 @@ class Dict(dict):
 	>>> d2.empty
 	Traceback (most recent call last):
 		...
-	AttributerError: 'Dict' object has no attribute 'empty'
+	AttributeError: 'Dict' object has no attribute 'empty'
 	>>> d3 = Dict(('a', 'b', 'c'), (1, 2, 3))
 	>>> d3.a
 	1
@@ -59,7 +59,7 @@ class Dict(dict):
 		try:
 			return self[key]
 		except KeyError:
-			raise AttributerError(r"'Dict' object has no attribute '%s'" % key)
+			raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
 	
 	def __setattr__(self, key, value):
 		self[key] = value
@@ -68,7 +68,7 @@ _TIMEDELTA_ZERO = datetime.timedelta(0)
 
 # timezone as UTC+8:00, UTC-10:00
 
-_RE_TZ = re.compile('^([\+\-])([0-9]{1.2})\:([0-9]{1,2})$')
+_RE_TZ = re.compile('^([\+\-])([0-9]{1,2})\:([0-9]{1,2})$')
 
 class UTC(datetime.tzinfo):
 	'''
@@ -112,7 +112,7 @@ class UTC(datetime.tzinfo):
 		else:
 			raise ValueError('bad utc time zone')
 
-	def utcoffset(sel, dt):
+	def utcoffset(self, dt):
 		return self._utcoffset
 
 	def dst(self, dt):
@@ -172,7 +172,7 @@ _RESPONSE_STATUSES = {
 	414: 'Request URI Too Long',
 	415: 'Unsupported Media Type',
 	416: 'Requested Range Not Satisfiable',
-	417: 'Expectation Failed'
+	417: 'Expectation Failed',
 	418: "I'm a teapot",
 	422: 'Unprocessable Entity',
 	423: 'Locked',
@@ -207,7 +207,7 @@ _RESPONSE_HEADERS = (
 	'Content-Range',
 	'Content-Type',
 	'Data',
-	'ETag'
+	'ETag',
 	'Expires',
 	'Last-Modified',
 	'Link',
@@ -243,7 +243,7 @@ class HttpError(Exception):
 	HttpError that defines http error code.
 
 	>>> e = HttpError(404)
-	>>> e.statues
+	>>> e.status
 	'404 Not Found'
 	'''
 	def __init__(self, code):
@@ -251,7 +251,7 @@ class HttpError(Exception):
 		Init an HttpError with response code.
 		'''
 		super(HttpError, self).__init__()
-		self.statues = '%d %s' % (code, _RESPONSE_STATUSES[code])
+		self.status = '%d %s' % (code, _RESPONSE_STATUSES[code])
 
 	def header(self, name, value):
 		if not hasattr(self, '_headers'):
@@ -265,7 +265,7 @@ class HttpError(Exception):
 		return []
 
 	def __str__(self):
-		return self.statues
+		return self.status
 
 	__repr__ = __str__
 
@@ -274,9 +274,9 @@ class RedirectError(HttpError):
 	RedirectError that defines http redirect code.
 
 	>>> e = RedirectError(302, 'http://www.apple.com/')
-	>>> e.statues
+	>>> e.status
 	'302 Found'
-	>>>> e.location
+	>>> e.location
 	'http://www.apple.com'
 	'''
 	def __init__(self, code, location):
@@ -287,7 +287,7 @@ class RedirectError(HttpError):
 		self.location = location
 	
 	def __str__(self):
-		return '%s, %s' % (self.statues, self.location)
+		return '%s, %s' % (self.status, self.location)
 
 	__repr__ = __str__
 
@@ -449,7 +449,7 @@ def get(path):
 	def index(id):
 		pass
 
-	>>>> @get('/test/:id')
+	>>> @get('/test/:id')
 	... def test():
 	... 	return 'ok'
 	...
@@ -487,6 +487,77 @@ def post(path):
 		return func
 	return _decorator
 
+def check_not_modified(etag, last_modified=None):
+	'''
+	Send the validators of the current version of a dynamic response: etag as a weak
+	ETag and last_modified, a timestamp or None, as Last-Modified. Return True, with
+	the response turned into a bodyless 304, if the client already holds this version.
+
+	>>> ctx.request = Request({'HTTP_IF_NONE_MATCH': 'W/"v1"'})
+	>>> ctx.response = Response()
+	>>> check_not_modified('v2'), ctx.response.status
+	(False, '200 OK')
+	>>> check_not_modified('v1'), ctx.response.status, ctx.response.header('ETag')
+	(True, '304 Not Modified', 'W/"v1"')
+	>>> del ctx.request, ctx.response
+	'''
+	response = ctx.response
+	etag = 'W/"%s"' % etag
+	response.set_header('ETag', etag)
+	if last_modified:
+		response.set_header('Last-Modified', email.utils.formatdate(int(last_modified), usegmt=True))
+	# cacheable, but always revalidated:
+	response.set_header('Cache-Control', 'private, no-cache')
+	if _not_modified(ctx.request, etag, last_modified):
+		response.status = 304
+		response.unset_header('Content-Type')
+		return True
+	return False
+
+def conditional(version_fn):
+	'''
+	A @conditional decorator that answers conditional GETs by 304 before the
+	function runs. version_fn is called with the arguments of the function and
+	returns (key, last_modified), or None to skip the check. key is any value
+	with a stable repr() that changes with everything the response shows,
+	last_modified a timestamp or None. Put it above @view, so nothing is
+	rendered for a 304.
+
+	@conditional(lambda blog_id: (Blog.get(blog_id).updated_at, None))
+	@view('blog.html')
+	@get('/blog/:blog_id')
+	def blog(blog_id):
+		pass
+	'''
+	def _decorator(func):
+		@functools.wraps(func)
+		def _wrapper(*args, **kw):
+			v = version_fn(*args, **kw)
+			if v is not None:
+				key, last_modified = v
+				# a deploy changes the asset urls in the pages:
+				etag = hashlib.md5(repr((ctx.application.get('version'), key))).hexdigest()
+				if check_not_modified(etag, last_modified):
+					return None
+			return func(*args, **kw)
+		return _wrapper
+	return _decorator
+
+def nocompress(func):
+	'''
+	A decorator that turns off gzip compression of the responses of a route.
+
+	>>> @nocompress
+	... @get('/download')
+	... def download():
+	... 	return 'ok'
+	...
+	>>> download.__web_compress__
+	False
+	'''
+	func.__web_compress__ = False
+	return func
+
 _re_route = re.compile(r'(\:[a-zA-Z_]\w*)')
 
 def _build_regex(path):
@@ -535,6 +606,7 @@ class Route(object):
 		self.is_static = _re_route.search(self.path) is None
 		if not self.is_static:
 			self.route = re.compile(_build_regex(self.path))
+		self.compress = getattr(func, '__web_compress__', True)
 		self.func = func
 	
 	def match(self, url):
@@ -553,70 +625,720 @@ class Route(object):
 
 	__repr__ = __str__
 
-def _static_file_generator(fpath):
-	BLOCK_SIZE = 8192
+def _static_file_generator(fpath, offset=0, length=None):
+	BLOCK_SIZE = 65536
 	with open(fpath, 'rb') as f:
-		block = f.read(BLOCK_SIZE)
-		while  block:
+		f.seek(offset)
+		while length is None or length > 0:
+			block = f.read(BLOCK_SIZE if length is None else min(BLOCK_SIZE, length))
+			if not block:
+				break
+			if length is not None:
+				length = length - len(block)
 			yield block
-			block = f.read(BLOCK_SIZE)
 
-class StaticFileRoute(object):
-	
+_RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def _parse_range(value, size):
+	'''
+	Return (start, end) of a single byte range, both inclusive, None if the Range
+	header is not a single byte range, or False if it cannot be satisfied.
+
+	>>> _parse_range('bytes=0-99', 1000), _parse_range('bytes=900-', 1000), _parse_range('bytes=-100', 1000)
+	((0, 99), (900, 999), (900, 999))
+	>>> _parse_range('bytes=0-1,5-6', 1000), _parse_range('bytes=1000-', 1000)
+	(None, False)
+	'''
+	m = _RE_RANGE.match(value.strip())
+	if not m or not (m.group(1) or m.group(2)):
+		return None
+	if not m.group(1):
+		n = int(m.group(2))
+		if n==0:
+			return False
+		return max(size - n, 0), size - 1
+	start = int(m.group(1))
+	end = int(m.group(2)) if m.group(2) else size - 1
+	if start >= size or end < start:
+		return False
+	return start, min(end, size - 1)
+
+def _not_modified(request, etag, mtime=None):
+	'''
+	Return True if the validators of the request match etag or mtime. Weak and strong
+	ETags compare equal, and If-None-Match takes precedence over If-Modified-Since.
+	'''
+	etags = request.header('If-None-Match')
+	if etags is not None:
+		if etags.strip()=='*':
+			return True
+		if etag is None:
+			return False
+		etag = etag[2:] if etag.startswith('W/') else etag
+		for t in etags.split(','):
+			t = t.strip()
+			if (t[2:] if t.startswith('W/') else t)==etag:
+				return True
+		return False
+	since = request.header('If-Modified-Since')
+	if since and mtime is not None:
+		t = email.utils.parsedate_tz(since)
+		return t is not None and email.utils.mktime_tz(t) >= int(mtime)
+	return False
+
+_STATIC_OPTIONS = dict(
+	static=False,
+	static_max_age=3600,
+	static_stat_interval=1.0,
+	static_small_file_size=256 * 1024,
+	static_cache_size=16 * 1024 * 1024)
+
+_STATIC_IMMUTABLE = 'public, max-age=31536000, immutable'
+
+def _file_digest(fpath):
+	md5 = hashlib.md5()
+	with open(fpath, 'rb') as f:
+		for block in iter(lambda: f.read(65536), ''):
+			md5.update(block)
+	return md5.hexdigest()
+
+class StaticManifest(object):
+	'''
+	Content-hashed names of the files under a static directory, built at startup.
+	A file is hashed again when its mtime or size changed, checked by stat() at
+	most once per check_interval seconds when its url is asked for. Earlier names
+	of a changed file still resolve, but are no longer current.
+
+	>>> m = StaticManifest(None)
+	>>> m.add('js/awesome.js', 'd41d8cd98f00b204e9800998ecf8427e')
+	>>> m.url('js/awesome.js')
+	'/static/js/awesome.d41d8cd9.js'
+	>>> m.resolve('js/awesome.d41d8cd9.js')
+	'js/awesome.js'
+	>>> m.url('js/unknown.js')
+	'/static/js/unknown.js'
+	>>> m.resolve('js/awesome.js') is None
+	True
+	>>> root = tempfile.mkdtemp()
+	>>> with open(os.path.join(root, 'a.css'), 'wb') as f:
+	... 	f.write('a {}')
+	>>> m = StaticManifest(root, check_interval=0)
+	>>> old = m.url('a.css')[len('/static/'):]
+	>>> old, m.is_current(old)
+	('a.3d1a83e5.css', True)
+	>>> with open(os.path.join(root, 'a.css'), 'wb') as f:
+	... 	f.write('a { color: red }')
+	>>> m.url('a.css'), m.resolve(old), m.is_current(old)
+	('/static/a.7067b21e.css', 'a.css', False)
+	>>> import shutil; shutil.rmtree(root)
+	'''
+	def __init__(self, static_dir, prefix='/static/', check_interval=1.0):
+		self._static_dir = static_dir
+		self._prefix = prefix
+		self.check_interval = check_interval
+		# 'js/awesome.js' -> 'js/awesome.d41d8cd9.js':
+		self._names = {}
+		# 'js/awesome.d41d8cd9.js' -> 'js/awesome.js', also for earlier names:
+		self._files = {}
+		# 'js/awesome.js' -> (mtime, size, checked_at) when it was hashed:
+		self._stats = {}
+		if static_dir and os.path.isdir(static_dir):
+			for root, dirs, files in os.walk(static_dir):
+				for fname in files:
+					# precompressed sidecars are served under the name of their file:
+					if fname.endswith('.gz'):
+						continue
+					fpath = os.path.join(root, fname)
+					self._hash(os.path.relpath(fpath, static_dir).replace(os.sep, '/'))
+			logging.info('Static manifest: %d files under %s' % (len(self._names), static_dir))
+
+	def __len__(self):
+		return len(self._names)
+
+	@property
+	def version(self):
+		'''
+		Hash of all current fingerprinted names, which changes with any static file.
+		'''
+		return hashlib.md5(repr(sorted(self._names.itervalues()))).hexdigest()
+
+	def add(self, path, digest):
+		base, ext = os.path.splitext(path)
+		name = '%s.%s%s' % (base, digest[:8], ext)
+		self._names[path] = name
+		self._files[name] = path
+
+	def _hash(self, path):
+		fpath = os.path.join(self._static_dir, path)
+		try:
+			st = os.stat(fpath)
+			digest = _file_digest(fpath)
+		except (OSError, IOError):
+			return
+		self._stats[path] = (int(st.st_mtime), st.st_size, time.time())
+		self.add(path, digest)
+
+	def _check(self, path):
+		e = self._stats.get(path)
+		if e is None or time.time() - e[2] < self.check_interval:
+			return
+		try:
+			st = os.stat(os.path.join(self._static_dir, path))
+		except OSError:
+			return
+		if (int(st.st_mtime), st.st_size)==e[:2]:
+			self._stats[path] = (e[0], e[1], time.time())
+		else:
+			self._hash(path)
+
+	def url(self, path):
+		'''
+		Return the fingerprinted url of path, or the plain url if the file is unknown.
+		'''
+		self._check(path)
+		return self._prefix + self._names.get(path, path)
+
+	def resolve(self, name):
+		'''
+		Return the path of a fingerprinted name, or None if name is not fingerprinted.
+		'''
+		return self._files.get(name)
+
+	def is_current(self, name):
+		'''
+		Return True if name is the fingerprinted name of the file as it is now.
+		'''
+		path = self._files.get(name)
+		if path is None:
+			return False
+		self._check(path)
+		return self._names.get(path)==name
+
+class _StaticFileInfo(object):
+
+	def __init__(self, fpath, st, checked_at):
+		self.fpath = fpath
+		self.mtime = int(st.st_mtime)
+		self.size = st.st_size
+		self.checked_at = checked_at
+		self.etag = '"%x-%x"' % (self.mtime, self.size)
+		self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+		self.content_type = mimetypes.types_map.get(os.path.splitext(fpath)[1].lower(), 'application/octet-stream')
+		self.data = None
+		# has a precompressed fpath.gz:
+		self.gz = False
+
+class _RouteNode(object):
+
 	def __init__(self):
-		self.method = 'GET'
-		self.is_static = False
-		self.route = re.compile('^/static/(.+)$')
+		# literal segment -> _RouteNode:
+		self.children = {}
+		# [(compiled regex or None for a plain ':param' segment, _RouteNode), ...]:
+		self.params = []
+		self.route = None
+		self.prefix_route = None
+
+class Router(object):
+	'''
+	Route lookup by a tree of path segments, so the lookup time grows with the
+	number of segments of the path, not with the number of routes. Paths without
+	parameters are looked up in a dict. At each segment a literal match is tried
+	before the ':param' segments, in the order the routes were added.
+
+	>>> @get('/blog/:id')
+	... def blog(id):
+	... 	return id
+	>>> @get('/blog/:id/comments')
+	... def comments(id):
+	... 	return id
+	>>> @get('/:user-:page/list')
+	... def page(user, page):
+	... 	return page
+	>>> router = Router()
+	>>> for f in (blog, comments, page):
+	... 	router.add(Route(f))
+	>>> router.add_prefix('/static/', 'static')
+	>>> router.match('/blog/123')
+	(Route(dynamic,GET,path=/blog/:id), ('123',))
+	>>> router.match('/blog/123/comments')
+	(Route(dynamic,GET,path=/blog/:id/comments), ('123',))
+	>>> router.match('/bob-2/list')
+	(Route(dynamic,GET,path=/:user-:page/list), ('bob', '2'))
+	>>> router.match('/static/js/app.js')
+	('static', ('js/app.js',))
+	>>> router.match('/blog/')
+	(None, None)
+	'''
+	def __init__(self):
+		self._static = {}
+		self._root = _RouteNode()
 
-	def match(self, url):
-		if url.startswith('/static'):
-			return (url[1:], )
+	def add(self, route):
+		if route.is_static:
+			self._static[route.path] = route
+			return
+		node = self._root
+		for seg in route.path.split('/'):
+			if _re_route.search(seg) is None:
+				node = node.children.setdefault(seg, _RouteNode())
+				continue
+			regex = None if _re_route.match(seg).group(0)==seg else re.compile(_build_regex(seg))
+			for r, child in node.params:
+				if (r and r.pattern)==(regex and regex.pattern):
+					node = child
+					break
+			else:
+				child = _RouteNode()
+				node.params.append((regex, child))
+				node = child
+		if node.route is None:
+			node.route = route
+
+	def add_prefix(self, prefix, route):
+		'''
+		Add route for all paths starting with prefix, called with the rest of the path.
+		'''
+		node = self._root
+		for seg in prefix.rstrip('/').split('/'):
+			node = node.children.setdefault(seg, _RouteNode())
+		node.prefix_route = route
+
+	def match(self, path):
+		'''
+		Return (route, args) for path, or (None, None) if no route matches.
+		'''
+		route = self._static.get(path)
+		if route:
+			return route, ()
+		r = self._match(self._root, path.split('/'), 0, ())
+		return r or (None, None)
+
+	def _match(self, node, segments, i, args):
+		if i==len(segments):
+			return node.route and (node.route, args)
+		seg = segments[i]
+		child = node.children.get(seg)
+		if child:
+			r = self._match(child, segments, i + 1, args)
+			if r:
+				return r
+		if seg:
+			for regex, child in node.params:
+				if regex is None:
+					r = self._match(child, segments, i + 1, args + (seg,))
+				else:
+					m = regex.match(seg)
+					r = m and self._match(child, segments, i + 1, args + m.groups())
+				if r:
+					return r
+		rest = '/'.join(segments[i:])
+		if node.prefix_route and rest:
+			return node.prefix_route, (rest,)
 		return None
 
+class StaticFileRoute(object):
+	'''
+	Serve files under document_root/static for '/static/'.
+
+	The validators (ETag, Last-Modified) of a file are computed once and kept
+	until its mtime or size changes, which is checked by stat() at most once per
+	stat_interval seconds. Conditional requests are answered by 304 and a single
+	byte range by 206. Files up to small_file_size bytes are kept in memory, in an
+	LRU of cache_size bytes; larger files are sent by wsgi.file_wrapper if the
+	server provides it. Fingerprinted names of the manifest are served with an
+	immutable Cache-Control.
+
+	If a file has an up to date fpath.gz sidecar, as written by assets.py, it is
+	sent to clients accepting gzip, except for range requests.
+
+	>>> root = tempfile.mkdtemp()
+	>>> os.mkdir(os.path.join(root, 'static'))
+	>>> for name in ('a.css', 'b.css'):
+	... 	with open(os.path.join(root, 'static', name), 'wb') as f:
+	... 		f.write('0123456789')
+	>>> route = StaticFileRoute(cache_size=10)
+	>>> def call(path, **headers):
+	... 	ctx.application = Dict(document_root=root)
+	... 	ctx.request = Request(dict([('HTTP_' + k, v) for k, v in headers.iteritems()]))
+	... 	ctx.response = Response()
+	... 	try:
+	... 		body = route(path)
+	... 		return ctx.response.status, ''.join(body)
+	... 	except HttpError, e:
+	... 		return e.status, None
+	>>> call('a.css'), ctx.response.content_length, ctx.response.content_type
+	(('200 OK', '0123456789'), '10', 'text/css')
+	>>> etag = ctx.response.header('ETag')
+	>>> call('a.css', IF_NONE_MATCH=etag)
+	('304 Not Modified', '')
+	>>> call('a.css', IF_MODIFIED_SINCE=ctx.response.header('Last-Modified'))
+	('304 Not Modified', '')
+	>>> call('a.css', RANGE='bytes=2-4'), ctx.response.header('Content-Range')
+	(('206 Partial Content', '234'), 'bytes 2-4/10')
+	>>> call('a.css', RANGE='bytes=2-4', IF_RANGE='"old"')
+	('200 OK', '0123456789')
+	>>> call('a.css', RANGE='bytes=20-'), ctx.response.header('Content-Range')
+	(('416 Requested Range Not Satisfiable', None), 'bytes */10')
+	>>> ctx.response.header('ETag'), ctx.response.header('Last-Modified'), ctx.response.content_type
+	(None, None, 'text/html; charset=utf-8')
+	>>> call('../b.css'), call('static/a.css'), call('missing.css')
+	(('404 Not Found', None), ('404 Not Found', None), ('404 Not Found', None))
+
+	Only the least recently used files up to cache_size bytes are kept in memory:
+
+	>>> call('b.css')
+	('200 OK', '0123456789')
+	>>> sorted([os.path.basename(p) for p, info in route._files.iteritems() if info.data is not None])
+	['b.css']
+	>>> import shutil; shutil.rmtree(root)
+	>>> del ctx.application, ctx.request, ctx.response
+	'''
+	def __init__(self, max_age=3600, stat_interval=1.0, small_file_size=256 * 1024, cache_size=16 * 1024 * 1024, manifest=None):
+		self.method = 'GET'
+		self.is_static = False
+		# validators and ranges refer to the identity encoding:
+		self.compress = False
+		self.max_age = max_age
+		self.stat_interval = stat_interval
+		self.small_file_size = small_file_size
+		self.cache_size = cache_size
+		self.manifest = manifest
+		self._lock = threading.Lock()
+		# fpath -> _StaticFileInfo, least recently used first:
+		self._files = collections.OrderedDict()
+		self._cached_bytes = 0
+
+	def _info(self, fpath):
+		now = time.time()
+		with self._lock:
+			info = self._files.pop(fpath, None)
+			if info is not None:
+				self._files[fpath] = info
+				if now - info.checked_at < self.stat_interval:
+					return info
+		try:
+			st = os.stat(fpath)
+		except OSError:
+			st = None
+		gz = st is not None and not fpath.endswith('.gz') and os.path.isfile(fpath + '.gz')
+		with self._lock:
+			if info is not None and st is not None and int(st.st_mtime)==info.mtime and st.st_size==info.size:
+				info.checked_at = now
+				info.gz = gz
+				return info
+			if fpath in self._files:
+				old = self._files.pop(fpath)
+				if old.data is not None:
+					self._cached_bytes = self._cached_bytes - len(old.data)
+			if st is None or not os.path.isfile(fpath):
+				return None
+			info = self._files[fpath] = _StaticFileInfo(fpath, st, now)
+			info.gz = gz
+		if info.size <= self.small_file_size:
+			with open(fpath, 'rb') as f:
+				data = f.read()
+			with self._lock:
+				if len(data)==info.size and self._files.get(fpath) is info:
+					info.data = data
+					self._cached_bytes = self._cached_bytes + len(data)
+					self._evict()
+		return info
+
+	def _evict(self):
+		# drop the data of the least recently used files, keep their validators:
+		for info in self._files.itervalues():
+			if self._cached_bytes <= self.cache_size:
+				break
+			if info.data is not None:
+				self._cached_bytes = self._cached_bytes - len(info.data)
+				info.data = None
+		while len(self._files) > 10000:
+			info = self._files.popitem(last=False)[1]
+			if info.data is not None:
+				self._cached_bytes = self._cached_bytes - len(info.data)
+
 	def __call__(self, *args):
-		fpath = os.path.join(ctx.application.document_root, args[0])
-		if not os.path.isfile(fpath):
+		path = args[0]
+		cache_control = 'public, max-age=%d' % self.max_age
+		if self.manifest is not None:
+			real_path = self.manifest.resolve(path)
+			if real_path is not None:
+				# an earlier name of a changed file gets the new bytes, but not for a year:
+				if self.manifest.is_current(path):
+					cache_control = _STATIC_IMMUTABLE
+				path = real_path
+		root = os.path.join(ctx.application.document_root, 'static')
+		fpath = os.path.abspath(os.path.join(root, path))
+		if not fpath.startswith(os.path.abspath(root) + os.sep):
 			raise notfound()
-		fext = os.path.splitext(fpath)[1]
-		ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+		info = self._info(fpath)
+		if info is None:
+			raise notfound()
+		request = ctx.request
+		response = ctx.response
+		range_header = request.header('Range')
+		response.content_type = info.content_type
+		if info.gz:
+			response.set_header('Vary', 'Accept-Encoding')
+			if not range_header and _accepts_gzip(request.header('Accept-Encoding', '')):
+				gz_info = self._info(fpath + '.gz')
+				if gz_info is not None and gz_info.mtime >= info.mtime:
+					response.set_header('Content-Encoding', 'gzip')
+					fpath, info = gz_info.fpath, gz_info
+		response.set_header('ETag', info.etag)
+		response.set_header('Last-Modified', info.last_modified)
+		response.set_header('Cache-Control', cache_control)
+		response.set_header('Accept-Ranges', 'bytes')
+		if _not_modified(request, info.etag, info.mtime):
+			response.status = 304
+			response.unset_header('Content-Type')
+			response.unset_header('Content-Encoding')
+			return []
+		r = None
+		if range_header and request.header('If-Range', info.etag)==info.etag:
+			r = _parse_range(range_header, info.size)
+			if r is False:
+				# the error page is html, without the validators of the file:
+				for name in ('ETag', 'Last-Modified', 'Cache-Control', 'Content-Encoding'):
+					response.unset_header(name)
+				response.content_type = 'text/html; charset=utf-8'
+				response.set_header('Content-Range', 'bytes */%d' % info.size)
+				raise HttpError(416)
+		if r:
+			start, end = r
+			response.status = 206
+			response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end, info.size))
+			response.content_length = end - start + 1
+			if info.data is not None:
+				return [info.data[start:end + 1]]
+			return _static_file_generator(fpath, start, end - start + 1)
+		response.content_length = info.size
+		if info.data is not None:
+			return [info.data]
+		file_wrapper = request.environ.get('wsgi.file_wrapper')
+		if file_wrapper:
+			return file_wrapper(open(fpath, 'rb'), 65536)
 		return _static_file_generator(fpath)
 
-	def favicon_handler():
-		return static_file_handler('/favicon.ico')
+class MultipartFile(object):
+	'''
+	Multipart file storage get from request input.
 
-	class MultipartFile(object):
-		'''
-		Multipart file storage get from request input.
+	f = ctx.request['file']
+	f.filename # 'test.png'
+	f.file # file-like object
+	'''
+	def __init__(self, storage):
+		self.filename = _to_unicode(storage.filename)
+		self.file = storage.file
 
-		f = ctx.request['file']
-		f.filename # 'test.png'
-		f.file # file-like object
-		'''
-		def __init__(self, storage):
-			self.filename = _to_unicode(storage.filename)
-			self.file = storage.file
+# default limits of request input, can be changed by WSGIApplication(**kw):
+_INPUT_LIMITS = dict(
+	max_body_size=10 * 1024 * 1024,
+	max_fields=1000,
+	max_file_size=10 * 1024 * 1024,
+	spool_size=512 * 1024)
+
+_MULTIPART_CHUNK = 65536
+_MULTIPART_MAX_HEADERS = 16384
+
+def _parse_multipart(fp, length, boundary, limits):
+	'''
+	Parse multipart/form-data as a stream, return [(name, value), ...] where value
+	is a str for fields and a MultipartFile for files. Files are kept in memory up
+	to spool_size bytes and spooled to a temporary file above.
+
+	>>> from StringIO import StringIO
+	>>> b = 'xYzZY'
+	>>> data = '--xYzZY\\r\\nContent-Disposition: form-data; name="a"\\r\\n\\r\\n1\\r\\n--xYzZY\\r\\nContent-Disposition: form-data; name="f"; filename="t.txt"\\r\\nContent-Type: text/plain\\r\\n\\r\\nline\\r\\n\\r\\n--xYzZY--\\r\\n'
+	>>> L = _parse_multipart(StringIO(data), len(data), b, _INPUT_LIMITS)
+	>>> L[0], L[1][0], L[1][1].filename, L[1][1].file.read()
+	(('a', '1'), 'f', u't.txt', 'line\\r\\n')
+	'''
+	state = dict(remaining=length)
+	def _read():
+		if state['remaining']<=0:
+			raise badrequest()
+		data = fp.read(min(_MULTIPART_CHUNK, state['remaining']))
+		if not data:
+			raise badrequest()
+		state['remaining'] = state['remaining'] - len(data)
+		return data
+	delimiter = '\r\n--' + boundary
+	# the first delimiter has no leading CRLF:
+	buf = '\r\n'
+	while True:
+		pos = buf.find(delimiter)
+		if pos>=0:
+			buf = buf[pos + len(delimiter):]
+			break
+		buf = buf[-len(delimiter):] + _read()
+	parts = []
+	while True:
+		while len(buf) < 2:
+			buf = buf + _read()
+		if buf.startswith('--'):
+			return parts
+		if not buf.startswith('\r\n'):
+			raise badrequest()
+		buf = buf[2:]
+		# part headers:
+		while True:
+			pos = buf.find('\r\n\r\n')
+			if pos>=0:
+				break
+			if len(buf) > _MULTIPART_MAX_HEADERS:
+				raise badrequest()
+			buf = buf + _read()
+		headers = {}
+		for line in buf[:pos].split('\r\n'):
+			k, sep, v = line.partition(':')
+			headers[k.strip().lower()] = v.strip()
+		buf = buf[pos + 4:]
+		disposition, params = cgi.parse_header(headers.get('content-disposition', ''))
+		if disposition!='form-data' or not 'name' in params:
+			raise badrequest()
+		if len(parts) >= limits['max_fields']:
+			raise badrequest()
+		is_file = 'filename' in params
+		if is_file:
+			out = tempfile.SpooledTemporaryFile(max_size=limits['spool_size'])
+			max_size = limits['max_file_size']
+		else:
+			out = StringIO()
+			max_size = limits['max_body_size']
+		size = 0
+		# copy the part body until the next delimiter:
+		while True:
+			pos = buf.find(delimiter)
+			n = pos if pos>=0 else max(len(buf) - len(delimiter), 0)
+			size = size + n
+			if size > max_size:
+				raise HttpError(413)
+			out.write(buf[:n])
+			if pos>=0:
+				buf = buf[pos + len(delimiter):]
+				break
+			buf = buf[n:] + _read()
+		if is_file:
+			out.seek(0)
+			parts.append((params['name'], MultipartFile(Dict(filename=params['filename'], file=out))))
+		else:
+			parts.append((params['name'], out.getvalue()))
+
+class _ReadOnlyDict(Dict):
+	'''
+	Dict that cannot be changed, returned as a view of request values that are
+	parsed once per request.
+
+	>>> d = _ReadOnlyDict(a=1)
+	>>> d.a
+	1
+	>>> d['b'] = 2
+	Traceback (most recent call last):
+		...
+	TypeError: read-only dict
+	'''
+	def _readonly(self, *args, **kw):
+		raise TypeError('read-only dict')
+
+	__setitem__ = __delitem__ = __setattr__ = _readonly
+	clear = pop = popitem = setdefault = update = _readonly
 
 class Request(object):
 	'''
-	Request object for obtaining all http request information.
+	Request object for obtaining all http request information. Values derived
+	from environ are computed on first access and kept for the request.
+	Applications can set their own attributes, like ctx.request.user.
 	'''
+	__slots__ = ('_environ', '_limits', '_body', '_json', '_raw_input', '_path_info', '_headers', '_cookies', '__dict__')
 
-	def __init__(self, environ):
+	def __init__(self, environ, limits=None):
 		self._environ = environ
+		self._limits = limits or _INPUT_LIMITS
+
+	def _content_type(self):
+		ctype = self._environ.get('CONTENT_TYPE', '')
+		if not ctype and self._environ.get('REQUEST_METHOD')=='POST':
+			return 'application/x-www-form-urlencoded', {}
+		return cgi.parse_header(ctype)
+
+	def _read_body(self):
+		'''
+		Read the request body at most once, limited to max_body_size.
+		'''
+		if not hasattr(self, '_body'):
+			max_size = self._limits['max_body_size']
+			length = self._environ.get('CONTENT_LENGTH')
+			fp = self._environ['wsgi.input']
+			if length:
+				if int(length) > max_size:
+					raise HttpError(413)
+				body = fp.read(int(length))
+			else:
+				body = fp.read(max_size + 1)
+				if len(body) > max_size:
+					raise HttpError(413)
+			self._body = body
+		return self._body
 
 	def _parse_input(self):
-		def _convert(item):
-			if isinstance(item, list):
-				return [_to_unicode(i.value) for i in item]
-			if item.filename:
-				return MultipartFile(item)
-			return _to_unicode(item.value)
-		fs = cgi.FieldStorage(fp=slef._environ['wsgi.input'], environ=self._environ, keep_blank_values=True)
+		'''
+		Parse the query string and the urlencoded or multipart body without
+		cgi.FieldStorage. A GET request only parses the query string.
+		'''
+		max_fields = self._limits['max_fields']
+		pairs = []
+		if self._environ.get('REQUEST_METHOD')=='POST':
+			ctype, params = self._content_type()
+			if ctype=='application/x-www-form-urlencoded':
+				pairs = urlparse.parse_qsl(self._read_body(), keep_blank_values=True)
+			elif ctype=='multipart/form-data':
+				if not params.get('boundary'):
+					raise badrequest()
+				length = int(self._environ.get('CONTENT_LENGTH') or 0)
+				if length > self._limits['max_body_size']:
+					raise HttpError(413)
+				pairs = _parse_multipart(self._environ['wsgi.input'], length, params['boundary'], self._limits)
+		qs = self._environ.get('QUERY_STRING')
+		if qs:
+			pairs = pairs + urlparse.parse_qsl(qs, keep_blank_values=True)
+		if len(pairs) > max_fields:
+			raise badrequest()
 		inputs = dict()
-		for key in fs:
-			inputs[key] = _convert(fs[key])
+		for k, v in pairs:
+			if isinstance(v, str):
+				v = _to_unicode(v)
+			if k in inputs:
+				r = inputs[k]
+				if isinstance(r, list):
+					r.append(v)
+				else:
+					inputs[k] = [r, v]
+			else:
+				inputs[k] = v
 		return inputs
 
+	@property
+	def json(self):
+		'''
+		Get the JSON body of an 'application/json' request, parsed once. Return None
+		for other requests, raise 400 Bad Request for a malformed body.
+
+		>>> from StringIO import StringIO
+		>>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_TYPE':'application/json', 'wsgi.input':StringIO('{"a": [1, 2]}')})
+		>>> r.json
+		{u'a': [1, 2]}
+		'''
+		if not hasattr(self, '_json'):
+			self._json = None
+			if self._content_type()[0]=='application/json':
+				try:
+					self._json = json.loads(self._read_body())
+				except ValueError:
+					raise badrequest()
+		return self._json
+
 	def _get_raw_input(self):
 		'''
 		Get raw input as dict containing values as unicode, list or MultipartFile.
@@ -641,9 +1363,9 @@ class Request(object):
 			...
 		KeyError: 'empty'
 		>>> b = '----WebKitFormBoundaryQQ3J8kPsjFpTmqNz'
-		>>> p1 = ['--%s' % b, 'Content-Disposition: form-data; name=\\"name\\"\\n', 'Scofield', '--%s' % b, 'Content-Disposition: form-data; name=\\"name\\"\\n, 'Lincoln' '--%s % b, 'Content-Disposition: form-data; name=\\"file\\"; filename=\\"test.txt\\"', 'content-type: text/plain\\n', 'just a test', '--%s' % b, 'Content-Disposition: form-data; name=\\"id\\"\\n', '4008009001', '--$s--' %b, '']
-		>>> payload = '\\n'.join(p1)
-		>>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT-LENGTH':str(len(payload)), 'CONTENT_TYPE':'multipart/form-data; boundary=%s' % b, 'wsgi.input':StringIO(payload)})
+		>>> p1 = ['--%s' % b, 'Content-Disposition: form-data; name="name"\\r\\n', 'Scofield', '--%s' % b, 'Content-Disposition: form-data; name="name"\\r\\n', 'Lincoln', '--%s' % b, 'Content-Disposition: form-data; name="file"; filename="test.txt"', 'Content-Type: text/plain\\r\\n', 'just a test', '--%s' % b, 'Content-Disposition: form-data; name="id"\\r\\n', '4008009001', '--%s--' % b, '']
+		>>> payload = '\\r\\n'.join(p1)
+		>>> r = Request({'REQUEST_METHOD':'POST', 'CONTENT_LENGTH':str(len(payload)), 'CONTENT_TYPE':'multipart/form-data; boundary=%s' % b, 'wsgi.input':StringIO(payload)})
 		>>> r.get('name')
 		u'Scofield'
 		>>> r.gets('name')
@@ -732,10 +1454,9 @@ class Request(object):
 		>>> from StringIO import StringIO
 		>>> r = Request({'REQUEST_METHOD':'POST', 'wsgi.input':StringIO('<xml><raw/>')})
 		>>> r.get_body()
-		'<xml><raw/>
+		'<xml><raw/>'
 		'''
-		fp =  slef._environ['wsgi.input']
-		return fp.read()
+		return self._read_body()
 
 	@property
 	def remote_addr(self):
@@ -801,7 +1522,7 @@ class Request(object):
 		>>> r.request_method
 		'POST'
 		'''
-		returned self._environ['REQUEST_METHOD']
+		return self._environ['REQUEST_METHOD']
 
 	@property
 	def path_info(self):
@@ -812,7 +1533,11 @@ class Request(object):
 		>>> r.path_info
 		'/test/a b.html'
 		'''
-		return urllib.unquote(self._environ.get('PATH_INFO', ''))
+		try:
+			return self._path_info
+		except AttributeError:
+			self._path_info = urllib.unquote(self._environ.get('PATH_INFO', ''))
+			return self._path_info
 
 	@property
 	def host(self):
@@ -826,32 +1551,35 @@ class Request(object):
 		return self._environ.get('HTTP_HOST', '')
 
 	def _get_headers(self):
-		if not hasattr(self, '_headers'):
-			hdrs = {}
+		try:
+			return self._headers
+		except AttributeError:
+			hdrs = dict.__new__(_ReadOnlyDict)
 			for k, v in self._environ.iteritems():
 				if k.startswith('HTTP_'):
 					# convert 'HTTP_ACCEPT_ENCODING' to 'ACCEPT-ENCODING'
-					hdrs[k[:5].replace('_', '-').upper()] = v.decode('utf-8')
+					dict.__setitem__(hdrs, k[5:].replace('_', '-'), v.decode('utf-8'))
 			self._headers =  hdrs
-		return self._headers
+			return hdrs
 
 	@property
 	def headers(self):
 		'''
-		Get all HTTP headers with key as str and value as unicode. The  header name are 'XXX-XXX' uppercase.
+		Get all HTTP headers as a read-only dict with key as str and value as unicode.
+		The header name are 'XXX-XXX' uppercase.
 
 		>>> r = Request({'HTTP_USER_AGENT':'Mozilla/5.0', 'HTTP_ACCEPT':'text/html'})
 		>>> H = r.headers
 		>>> H['ACCEPT']
 		u'text/html'
-		>>> H['USER_AGENT']
+		>>> H['USER-AGENT']
 		u'Mozilla/5.0'
 		>>> L = H.items()
 		>>> L.sort()
 		>>> L
 		[('ACCEPT', u'text/html'), ('USER-AGENT', u'Mozilla/5.0')]
 		'''
-		return dict(**self._get_headers())
+		return self._get_headers()
 
 	def header(self, header, default=None):
 		'''
@@ -869,32 +1597,36 @@ class Request(object):
 		>>> r.header('Test', u'DEFAULT')
 		u'DEFAULT'
 		'''
-		return self._get_headers().get(header.upper(), default)
+		# look up the single environ key instead of building all headers:
+		v = self._environ.get('HTTP_' + header.upper().replace('-', '_'))
+		return default if v is None else v.decode('utf-8')
 
 	def _get_cookies(self):
-		if not hasattr(self, '_cookies'):
-			cookies = {}
+		try:
+			return self._cookies
+		except AttributeError:
+			cookies = dict.__new__(_ReadOnlyDict)
 			cookie_str = self._environ.get('HTTP_COOKIE')
 			if cookie_str:
 				for c in cookie_str.split(';'):
 					pos = c.find('=')
 					if pos>0:
-						cookies[c[:pos].stip()] = _unquote(c[pos+1:])
+						dict.__setitem__(cookies, c[:pos].strip(), _unquote(c[pos+1:]))
 			self._cookies = cookies
-		return slef._cookies
+			return cookies
 
 	@property
 	def cookies(self):
 		'''
-		Return all cookies as dict. The cookie name is str and values is unicode.
+		Return all cookies as read-only dict. The cookie name is str and values is unicode.
 
-		>>> r = Request({'HTTP_COOKE':'A=123; url=http%3A%2F%2Fwww.example.com%2F'})
+		>>> r = Request({'HTTP_COOKIE':'A=123; url=http%3A%2F%2Fwww.example.com%2F'})
 		>>> r.cookies['A']
 		u'123'
 		>>> r.cookies['url']
 		u'http://www.example.com/'
 		'''
-		return Dict(**self._get_cookies())
+		return self._get_cookies()
 
 	def cookie(self, name, default=None):
 		'''
@@ -914,11 +1646,18 @@ class Request(object):
 UTC_0 = UTC('+00:00')
 
 class Response(object):
-	
+	'''
+	Response object. Headers are kept as the list passed to start_response().
+	A handler can set ctx.response.compress = False to send the response uncompressed.
+	'''
+	__slots__ = ('_status', '_headers', '_cookies', 'compress')
+
 	def __init__(self):
 		self._status = '200 OK'
-		self._headers = {'CONTENT-TYPE': 'text/html; charset=utf-8'}
-	
+		self._headers = [('Content-Type', 'text/html; charset=utf-8'), _HEADER_X_POWERED_BY]
+		self._cookies = None
+		self.compress = True
+
 	@property
 	def headers(self):
 		'''
@@ -926,17 +1665,14 @@ class Response(object):
 
 		>>> r = Response()
 		>>> r.headers
-		[('Content-Type', 'text/html; charset=utf-8'), ('X-Powered-By', 'transwarp/1.0')]
+		[('Content-Type', 'text/html; charset=utf-8'), ('X-Powered-By', 'Transwarp/1.0')]
 		>>> r.set_cookie('s1', 'ok', 3600)
 		>>> r.headers
-		[('Content-Type', 'text/html; charset=utf-8'), ('Set-Cookie', 's1=ok; Max-Age=3600; Path=/; HttpOnly'), ('X-Powered-By', 'transwarp/1.0')]
+		[('Content-Type', 'text/html; charset=utf-8'), ('X-Powered-By', 'Transwarp/1.0'), ('Set-Cookie', 's1=ok; Max-Age=3600; Path=/; HttpOnly')]
 		'''
-		L = [(_RESPONSE_HEADER_DICT.get(k, k), v) for k, v in self._headers.iteritems()]
-		if hasattr(self, '_cookies'):
-			for v in self._cookies.iteritems():
-				L.append(('Set-Cookie', v))
-		L.append(_HEADER_X_POWERED_BY)
-		return L
+		if not self._cookies:
+			return self._headers
+		return self._headers + [('Set-Cookie', v) for v in self._cookies.itervalues()]
 
 	def header(self, name):
 		'''
@@ -948,11 +1684,13 @@ class Response(object):
 		>>> r.header('CONTENT-type')
 		'text/html; charset=utf-8'
 		>>> r.header('X-Powered-By')
+		'Transwarp/1.0'
 		'''
-		key = name.upper()
-		if not key in _RESPONSE_HEADER_DICT:
-			key = name
-		return self._headers.get(key)
+		key = _RESPONSE_HEADER_DICT.get(name.upper(), name)
+		for k, v in self._headers:
+			if k==key:
+				return v
+		return None
 
 	def unset_header(self, name):
 		'''
@@ -964,11 +1702,8 @@ class Response(object):
 		>>> r.unset_header('CONTENT-type')
 		>>> r.header('content_type')
 		'''
-		key = name.upper()
-		if not key in _RESPONSE_HEADER_DICT:
-			key = name
-		if key in self._headers:
-			del self._headers[key]
+		key = _RESPONSE_HEADER_DICT.get(name.upper(), name)
+		self._headers = [h for h in self._headers if h[0]!=key]
 
 	def set_header(self, name, value):
 		'''
@@ -981,10 +1716,14 @@ class Response(object):
 		>>> r.header('content-TYPE')
 		'image/png'
 		'''
-		key = name.upper()
-		if not key in _RESPONSE_HEADER_DICT:
-			key = name
-		self._headers[key] = _to_str(value)
+		key = _RESPONSE_HEADER_DICT.get(name.upper(), name)
+		value = _to_str(value)
+		L = self._headers
+		for i in range(len(L)):
+			if L[i][0]==key:
+				L[i] = (key, value)
+				return
+		L.append((key, value))
 
 	@property
 	def content_type(self):
@@ -1047,7 +1786,7 @@ class Response(object):
 		'''
 		self.set_cookie(name, '__deleted__', expires=0)
 		
-	def set_cookie(self, name, value, max_age=None, path='/', domain=None, secure=False, http_only=True):
+	def set_cookie(self, name, value, max_age=None, expires=None, path='/', domain=None, secure=False, http_only=True):
 		'''
 		Set a cookie.
 
@@ -1075,7 +1814,7 @@ class Response(object):
 		>>> r._cookies
 		{'company': 'company=Expires; Expires=Sat, 14-Jul-2014 14:06:34 GMT; Path=/; HttpOnly'}
 		'''
-		if not hasattr(self, '_cookies'):
+		if self._cookies is None:
 			self._cookies = {}
 		L = ['%s=%s' % (_quote(name), _quote(value))]
 		if expires is not None:
@@ -1106,9 +1845,8 @@ class Response(object):
 		>>> r._cookies
 		{}
 		'''
-		if hasattr(self, '_cookies'):
-			if name in self._cookies:
-				del self._cookies[name]
+		if self._cookies and name in self._cookies:
+			del self._cookies[name]
 
 	@property
 	def status_code(self):
@@ -1237,6 +1975,9 @@ class Jinja2TemplateEngine(TemplateEngine):
 	def add_filter(self, name, fn_filter):
 		self._env.filters[name] = fn_filter
 
+	def add_global(self, name, value):
+		self._env.globals[name] = value
+
 	def __call__(self, path, model):
 		return self._env.get_template(path).render(**model).encode('utf-8')
 
@@ -1284,18 +2025,113 @@ def view(path):
 		return _wrapper
 	return _decorator
 
+# default gzip options, can be changed by WSGIApplication(**kw):
+_GZIP_OPTIONS = dict(
+	gzip=True,
+	gzip_level=6,
+	gzip_min_size=1024,
+	gzip_types=('text/html', 'text/plain', 'text/css', 'text/xml', 'application/json', 'application/javascript', 'application/xml'))
+
+def _accepts_gzip(accept_encoding):
+	'''
+	Return True if the Accept-Encoding header value accepts gzip.
+
+	>>> _accepts_gzip('gzip, deflate')
+	True
+	>>> _accepts_gzip('deflate, gzip;q=0')
+	False
+	>>> _accepts_gzip('*')
+	True
+	>>> _accepts_gzip('')
+	False
+	'''
+	for coding in accept_encoding.split(','):
+		name, sep, q = coding.partition(';')
+		if name.strip().lower() in ('gzip', '*'):
+			q = q.strip()
+			if q.startswith('q='):
+				try:
+					return float(q[2:]) > 0
+				except ValueError:
+					return False
+			return True
+	return False
+
+def _gzip_stream(chunks, level):
+	# flush after each chunk, so every chunk is sent as soon as it is produced:
+	c = zlib.compressobj(level, zlib.DEFLATED, 31)
+	for chunk in chunks:
+		if isinstance(chunk, unicode):
+			chunk = chunk.encode('utf-8')
+		yield c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+	yield c.flush()
+
+def _gzip_response(r, response, accept_encoding, options):
+	'''
+	Return the body compressed by gzip if the client accepts it, and the
+	content type and size qualify, and set the response headers.
+
+	>>> r = Response()
+	>>> body = _gzip_response('<p>hello</p>' * 100, r, 'gzip', _GZIP_OPTIONS)
+	>>> r.header('Content-Encoding'), r.header('Vary'), int(r.header('Content-Length'))==len(body[0])
+	('gzip', 'Accept-Encoding', True)
+	>>> zlib.decompress(body[0], 31)==('<p>hello</p>' * 100)
+	True
+	>>> _gzip_response('<p>hello</p>', Response(), 'gzip', _GZIP_OPTIONS)
+	'<p>hello</p>'
+	'''
+	if response.status_code!=200 or response.header('Content-Encoding'):
+		return r
+	ctype = (response.content_type or '').split(';', 1)[0].strip().lower()
+	if not ctype in options['gzip_types']:
+		return r
+	vary = response.header('Vary')
+	if not vary:
+		response.set_header('Vary', 'Accept-Encoding')
+	elif not 'accept-encoding' in vary.lower():
+		response.set_header('Vary', '%s, Accept-Encoding' % vary)
+	if not _accepts_gzip(accept_encoding):
+		return r
+	level = options['gzip_level']
+	if isinstance(r, (str, list, tuple)):
+		body = r if isinstance(r, str) else ''.join(r)
+		if len(body) < options['gzip_min_size']:
+			return r
+		c = zlib.compressobj(level, zlib.DEFLATED, 31)
+		body = c.compress(body) + c.flush()
+		response.set_header('Content-Encoding', 'gzip')
+		response.content_length = len(body)
+		return [body]
+	response.unset_header('Content-Length')
+	response.set_header('Content-Encoding', 'gzip')
+	return _gzip_stream(r, level)
+
 _RE_INTERCEPTROR_STARTS_WITH = re.compile(r'^([^\*\?]+)\*?$')
 _RE_INTERCEPTROR_ENDS_WITH = re.compile(r'^\*([^\*\?]+)$')
 
-def _build_pattern_fn(pattern):
+def _parse_pattern(pattern):
+	'''
+	Return ('startswith', prefix) or ('endswith', suffix) of interceptor pattern.
+
+	>>> _parse_pattern('/manage/')
+	('startswith', '/manage/')
+	>>> _parse_pattern('*.html')
+	('endswith', '.html')
+	'''
 	m = _RE_INTERCEPTROR_STARTS_WITH.match(pattern)
 	if m:
-		return lambda p: p.startswith(m.group(1))
+		return 'startswith', m.group(1)
 	m = _RE_INTERCEPTROR_ENDS_WITH.match(pattern)
 	if m:
-		return lambda p: p.endswith(m.group(1))
+		return 'endswith', m.group(1)
 	raise ValueError('Invalid pattern definition in interceptor.')
 
+def _build_pattern_fn(pattern):
+	kind, value = _parse_pattern(pattern)
+	if kind=='startswith':
+		return lambda p: p.startswith(value)
+	return lambda p: p.endswith(value)
+
 def interceptor(pattern='/'):
 	'''
 	An @interceptor decorator.
@@ -1306,6 +2142,7 @@ def interceptor(pattern='/'):
 	'''
 	def _decorator(func):
 		func.__interceptor__ = _build_pattern_fn(pattern)
+		func.__interceptor_pattern__ = _parse_pattern(pattern)
 		return func
 	return _decorator
 
@@ -1367,6 +2204,65 @@ def _build_interceptor_chain(last_fn, *interceptors):
 		fn = _build_interceptor_fn(f, fn)
 	return fn
 
+def _route_bounds(path):
+	'''
+	Return the literal (prefix, suffix) that all paths matching a dynamic route path have.
+
+	>>> _route_bounds('/blog/:id/comments')
+	('/blog/', '/comments')
+	>>> _route_bounds('/api/:id')
+	('/api/', '')
+	'''
+	params = list(_re_route.finditer(path))
+	return path[:params[0].start()], path[params[-1].end():]
+
+def _interceptor_applies(func, prefix, suffix):
+	'''
+	Return True if interceptor applies to all paths starting with prefix and ending
+	with suffix, False if it applies to none of them, or None if it depends on the path.
+
+	>>> @interceptor('/manage/')
+	... def manage(next):
+	... 	return next()
+	>>> _interceptor_applies(manage, '/manage/blogs/', '')
+	True
+	>>> _interceptor_applies(manage, '/api/', '')
+	False
+	>>> _interceptor_applies(manage, '/', '/edit')
+	'''
+	kind, value = getattr(func, '__interceptor_pattern__', (None, None))
+	if kind=='startswith':
+		if prefix.startswith(value):
+			return True
+		if not value.startswith(prefix):
+			return False
+	if kind=='endswith':
+		if suffix.endswith(value):
+			return True
+		if not value.endswith(suffix):
+			return False
+	return None
+
+def _build_route_chain(route, interceptors):
+	'''
+	Build the interceptor chain of a route from [(interceptor, always), ...],
+	the pattern of an interceptor is only checked per request if not always.
+	A route without interceptors is returned as is.
+	'''
+	fn = route
+	for func, always in reversed(interceptors):
+		fn = _build_route_interceptor_fn(func, fn, always)
+	return fn
+
+def _build_route_interceptor_fn(func, next, always):
+	if always:
+		return lambda *args: func(lambda: next(*args))
+	def _wrapper(*args):
+		if func.__interceptor__(ctx.request.path_info):
+			return func(lambda: next(*args))
+		return next(*args)
+	return _wrapper
+
 def _load_module(module_name):
 	'''
 	Load module from name as str.
@@ -1389,6 +2285,164 @@ def _load_module(module_name):
 	m = __import__(from_module, globals(), locals(), [import_module])
 	return getattr(m, import_module)
 
+class PageCache(object):
+	'''
+	WSGI middleware caching whole responses of anonymous GET requests:
+
+	application = PageCache(wsgi.get_wsgi_application(), ttl=60)
+
+	Entries are keyed by path, normalized query string and whether the client
+	accepts gzip, and hold the status, headers and body, so a hit is one dict
+	lookup. Requests with the session cookie, other methods and paths under
+	bypass_prefixes go to the application. Only 200 responses without Set-Cookie
+	or 'Cache-Control: no-store' are stored. Write handlers or change listeners
+	drop stale pages by invalidate() or invalidate_prefix(); an entry is also
+	dropped after ttl seconds.
+
+	>>> calls = []
+	>>> def app(env, start_response):
+	... 	path = env['PATH_INFO']
+	... 	calls.append(path)
+	... 	headers = [('Content-Type', 'text/html'), ('ETag', 'W/"1"')]
+	... 	if path=='/error':
+	... 		headers.append(('Cache-Control', 'no-store'))
+	... 	if path=='/racy':
+	... 		cache.invalidate('/racy')
+	... 	start_response('200 OK', headers)
+	... 	return ['page ', path]
+	>>> cache = PageCache(app, ttl=60)
+	>>> def get(path, qs='', **headers):
+	... 	env = dict(REQUEST_METHOD='GET', PATH_INFO=path, QUERY_STRING=qs)
+	... 	env.update([('HTTP_' + k, v) for k, v in headers.iteritems()])
+	... 	status = []
+	... 	body = ''.join(cache(env, lambda s, h, exc_info=None: status.append(s)))
+	... 	return status[0], body
+
+	A hit, also with the query parameters in another order:
+
+	>>> get('/', 'b=2&a=1'), get('/', 'a=1&b=2'), calls
+	(('200 OK', 'page /'), ('200 OK', 'page /'), ['/'])
+	>>> get('/', 'a=1&b=2', IF_NONE_MATCH='W/"1"')
+	('304 Not Modified', '')
+	>>> sorted(cache.stats().items())
+	[('entries', 1), ('hits', 2), ('misses', 1)]
+
+	The session cookie, other methods, bypassed paths and no-store responses
+	always go to the application:
+
+	>>> get('/', 'a=1&b=2', COOKIE='lang=en; awesession=1-2-3')
+	('200 OK', 'page /')
+	>>> cache({'REQUEST_METHOD': 'POST', 'PATH_INFO': '/'}, lambda s, h: None)
+	['page ', '/']
+	>>> get('/static/a.css'), get('/static/a.css'), get('/error'), get('/error')
+	(('200 OK', 'page /static/a.css'), ('200 OK', 'page /static/a.css'), ('200 OK', 'page /error'), ('200 OK', 'page /error'))
+	>>> calls
+	['/', '/', '/', '/static/a.css', '/static/a.css', '/error', '/error']
+
+	Invalidation drops the pages of a path with any query string, or of a prefix:
+
+	>>> del calls[:]
+	>>> get('/blog/1'), get('/blog/2'), cache.invalidate('/')
+	(('200 OK', 'page /blog/1'), ('200 OK', 'page /blog/2'), None)
+	>>> get('/', 'a=1&b=2'), cache.invalidate_prefix('/blog/'), cache.stats()['entries']
+	(('200 OK', 'page /'), None, 1)
+	>>> calls
+	['/blog/1', '/blog/2', '/']
+
+	A page rendered while an invalidation happens is not stored:
+
+	>>> get('/racy'), get('/racy'), calls.count('/racy')
+	(('200 OK', 'page /racy'), ('200 OK', 'page /racy'), 2)
+
+	A server adding its own headers to a hit does not change the cached page:
+
+	>>> server = lambda s, h, exc_info=None: h.append(('Date', 'now'))
+	>>> env = dict(REQUEST_METHOD='GET', PATH_INFO='/blog/3')
+	>>> body = cache(env, server); body = cache(env, server); body = cache(env, server)
+	>>> [h for h in cache._entries.values()[-1][2] if h[0]=='Date']
+	[]
+	'''
+	def __init__(self, app, ttl=60, max_entries=1000, max_body_size=1024 * 1024, cookie='awesession', bypass_prefixes=('/static/', '/manage/')):
+		self._app = app
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.max_body_size = max_body_size
+		self.bypass_prefixes = tuple(bypass_prefixes)
+		self.hits = 0
+		self.misses = 0
+		self._re_cookie = re.compile(r'(?:^|;)\s*%s=' % re.escape(cookie))
+		self._lock = threading.Lock()
+		# (path, query, gzip) -> (expires, status, headers, body), oldest first:
+		self._entries = collections.OrderedDict()
+		# incremented by each invalidation, so a response rendered before it is not stored:
+		self._generation = 0
+
+	def _key(self, env):
+		qs = env.get('QUERY_STRING', '')
+		if qs:
+			qs = urllib.urlencode(sorted(urlparse.parse_qsl(qs, keep_blank_values=True)))
+		return env.get('PATH_INFO', '/'), qs, _accepts_gzip(env.get('HTTP_ACCEPT_ENCODING', ''))
+
+	def __call__(self, env, start_response):
+		path = env.get('PATH_INFO', '/')
+		if env.get('REQUEST_METHOD')!='GET' or path.startswith(self.bypass_prefixes) or self._re_cookie.search(env.get('HTTP_COOKIE', '')):
+			return self._app(env, start_response)
+		key = self._key(env)
+		e = self._entries.get(key)
+		if e is not None and e[0] > time.time():
+			self.hits = self.hits + 1
+			etag = env.get('HTTP_IF_NONE_MATCH')
+			if etag and ('ETag', etag) in e[2]:
+				start_response('304 Not Modified', [h for h in e[2] if h[0] in ('ETag', 'Cache-Control', 'Vary', 'Last-Modified')])
+				return []
+			start_response(e[1], list(e[2]))
+			return [e[3]]
+		self.misses = self.misses + 1
+		generation = self._generation
+		captured = []
+		def _start_response(status, headers, exc_info=None):
+			# copied before the server may add its own headers to the list:
+			captured[:] = [status, list(headers)]
+			return start_response(status, headers, exc_info)
+		body = self._app(env, _start_response)
+		if not captured or not captured[0].startswith('200 ') or [h for h in captured[1] if h[0].lower()=='set-cookie' or (h[0].lower()=='cache-control' and 'no-store' in h[1])]:
+			return body
+		try:
+			data = ''.join(body)
+		finally:
+			if hasattr(body, 'close'):
+				body.close()
+		if len(data) <= self.max_body_size:
+			with self._lock:
+				if generation==self._generation:
+					self._entries.pop(key, None)
+					self._entries[key] = (time.time() + self.ttl, captured[0], captured[1], data)
+					while len(self._entries) > self.max_entries:
+						self._entries.popitem(last=False)
+		return [data]
+
+	def invalidate(self, *paths):
+		'''
+		Drop the cached pages of the paths, with any query string.
+		'''
+		paths = set(paths)
+		with self._lock:
+			self._generation = self._generation + 1
+			for key in [k for k in self._entries if k[0] in paths]:
+				del self._entries[key]
+
+	def invalidate_prefix(self, prefix='/'):
+		'''
+		Drop the cached pages of all paths starting with prefix.
+		'''
+		with self._lock:
+			self._generation = self._generation + 1
+			for key in [k for k in self._entries if k[0].startswith(prefix)]:
+				del self._entries[key]
+
+	def stats(self):
+		return dict(hits=self.hits, misses=self.misses, entries=len(self._entries))
+
 class WSGIApplication(object):
 	
 	def __init__(self, document_root=None, **kw):
@@ -1397,21 +2451,47 @@ class WSGIApplication(object):
 
 		Args:
 			document_root: document root path.
+			max_body_size: optional, max bytes of request body, default to 10 MB.
+			max_fields: optional, max number of input fields, default to 1000.
+			max_file_size: optional, max bytes of an uploaded file, default to 10 MB.
+			spool_size: optional, uploaded files above this size are spooled to disk, default to 512 KB.
+			gzip: optional, compress responses by gzip if the client accepts it, default to True.
+			gzip_level: optional, compression level, default to 6.
+			gzip_min_size: optional, responses smaller than this are not compressed, default to 1024.
+			gzip_types: optional, content types that are compressed, default to html, text, css, xml, json and javascript.
+			static: optional, serve '/static/' also when not in debug mode, default to False.
+				Set it if templates link static_manifest.url(), see get_wsgi_application().
+			static_max_age: optional, max-age of Cache-Control for static files, default to 3600.
+			static_stat_interval: optional, seconds between checks of a static file for changes, default to 1.
+			static_small_file_size: optional, static files up to this size are cached in memory, default to 256 KB.
+			static_cache_size: optional, max bytes of static files cached in memory, default to 16 MB.
 		'''
 		self._running = False
 		self._document_root = document_root
+		self._input_limits = dict(_INPUT_LIMITS)
+		for k in _INPUT_LIMITS:
+			if k in kw:
+				self._input_limits[k] = kw[k]
+		self._gzip = dict(_GZIP_OPTIONS)
+		for k in _GZIP_OPTIONS:
+			if k in kw:
+				self._gzip[k] = kw[k]
+		self._static = dict(_STATIC_OPTIONS)
+		for k in _STATIC_OPTIONS:
+			if k in kw:
+				self._static[k] = kw[k]
 
 		self._interceptors = []
 		self._template_engine = None
+		self._static_manifest = None
 
-		self._get_static = {}
-		self._post_static = {}
+		self._routes = []
 
-		self._get_dynamic = []
-		self._post_dynamic = []
+		self._get_router = Router()
+		self._post_router = Router()
 
 	def _check_not_running(self):
-		if self.running:
+		if self._running:
 			raise RuntimeError('Cannot modify WSGIApplication when running')
 
 	@property
@@ -1423,6 +2503,15 @@ class WSGIApplication(object):
 		self._check_not_running()
 		self._template_engine = engine
 
+	@property
+	def static_manifest(self):
+		'''
+		The StaticManifest of document_root/static, built on first access.
+		'''
+		if self._static_manifest is None:
+			self._static_manifest = StaticManifest(os.path.join(self._document_root, 'static') if self._document_root else None, check_interval=self._static['static_stat_interval'])
+		return self._static_manifest
+
 	def add_module(self, mod):
 		self._check_not_running()
 		m = mod if type(mod)==types.ModuleType else _load_module(mod)
@@ -1435,16 +2524,11 @@ class WSGIApplication(object):
 	def add_url(self, func):
 		self._check_not_running()
 		route = Route(func)
-		if route.is_static:
-			if route.method=='GET':
-				self._get_static[route.path] = route
-			if route.method=='POST':
-				self._post_static[route.path] = route
-		else:
-			if route.method='GET':
-				self._get_dynamic.append(route)
-			if route.method='POST':
-				self._post_dynamic.append(route)
+		self._routes.append(route)
+		if route.method=='GET':
+			self._get_router.add(route)
+		if route.method=='POST':
+			self._post_router.add(route)
 		logging.info('Add route: %s' % str(route))
 
 	def add_interceptor(self, func):
@@ -1456,44 +2540,85 @@ class WSGIApplication(object):
 		from wsgiref.simple_server import make_server
 		logging.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
 		server = make_server(host, port, self.get_wsgi_application(debug=True))
-		server.server_forever()
+		server.serve_forever()
 
 	def get_wsgi_application(self, debug=False):
+		'''
+		Return the WSGI callable. '/static/' is served in debug mode, or with
+		static=True, which a production app needs if its templates link the
+		fingerprinted urls of static_manifest: no file has those names on disk,
+		so a front server cannot serve them by itself.
+
+		>>> root = tempfile.mkdtemp()
+		>>> os.mkdir(os.path.join(root, 'static'))
+		>>> with open(os.path.join(root, 'static', 'a.css'), 'wb') as f:
+		... 	f.write('a {}')
+		>>> def get(app, path):
+		... 	status = []
+		... 	body = app(dict(REQUEST_METHOD='GET', PATH_INFO=path), lambda s, h: status.append(s))
+		... 	return status[0], ''.join(body)
+		>>> wsgi = WSGIApplication(root, static=True)
+		>>> url = wsgi.static_manifest.url('a.css')
+		>>> url
+		'/static/a.3d1a83e5.css'
+		>>> get(wsgi.get_wsgi_application(), url)
+		('200 OK', 'a {}')
+		>>> get(WSGIApplication(root).get_wsgi_application(), url)[0]
+		'404 Not Found'
+		>>> import shutil; shutil.rmtree(root)
+		'''
 		self._check_not_running()
-		if debug:
-			self._get_dynamic.append(StaticFileRoute())
+		if debug or self._static['static']:
+			options = self._static
+			static_route = StaticFileRoute(options['static_max_age'], options['static_stat_interval'], options['static_small_file_size'], options['static_cache_size'], self.static_manifest)
+			self._get_router.add_prefix('/static/', static_route)
 		self._running = True
 
-		_application = Dict(document_root=self, _document_root)
-
-		def fn_route():
-			request_method = ctx.request.request_method
-			path_info = ctx.request.path_info
-			if request_method=='GET':
-				fn = self._get_static.get(path_info, None)
-				if fn:
-					return fn()
-				for fn in self._get_dynamic:
-					args = fn.match(path_info)
-					if args:
-						return fn(*args)
-				raise notfound()
-			if request_method=='POST':
-				fn =self._post_static.get(path_info, None)
-				if fn:
-					return fn()
-				for fn in self._post_dynamic:
-					args = fn.match(path_info)
-					if args:
-						return fn(*args)
-				raise notfound()
+		_application = Dict(document_root=self._document_root, version=self.static_manifest.version)
+
+		# resolve the interceptors of each route once, by the literal prefix and suffix of its paths:
+		bounds = []
+		for route in self._routes:
+			bounds.append((route, ) + ((route.path, route.path) if route.is_static else _route_bounds(route.path)))
+		if debug or self._static['static']:
+			bounds.append((static_route, '/static/', ''))
+		chains = {}
+		for route, prefix, suffix in bounds:
+			L = []
+			for func in self._interceptors:
+				applies = func.__interceptor__(prefix) if route.is_static else _interceptor_applies(func, prefix, suffix)
+				if applies is not False:
+					L.append((func, applies))
+			chains[route] = _build_route_chain(route, L)
+
+		def fn_notfound():
+			raise notfound()
+
+		def fn_badrequest():
 			raise badrequest()
 
-		fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+		# requests matching no route still pass all interceptors:
+		fn_notfound = _build_interceptor_chain(fn_notfound, *self._interceptors)
+		fn_badrequest = _build_interceptor_chain(fn_badrequest, *self._interceptors)
+
+		routers = dict(GET=self._get_router, POST=self._post_router)
+
+		def fn_exec():
+			router = routers.get(ctx.request.request_method)
+			if router is None:
+				return fn_badrequest()
+			fn, args = router.match(ctx.request.path_info)
+			if fn is None:
+				return fn_notfound()
+			if not fn.compress:
+				ctx.response.compress = False
+			return chains[fn](*args)
+
+		gzip = self._gzip if self._gzip['gzip'] else None
 
 		def wsgi(env, start_response):
 			ctx.application = _application
-			ctx.request = Request(env)
+			ctx.request = Request(env, self._input_limits)
 			response = ctx.response = Response()
 			try:
 				r = fn_exec()
@@ -1503,6 +2628,8 @@ class WSGIApplication(object):
 					r = r.encode('utf-8')
 				if r is None:
 					r = []
+				elif gzip and response.compress:
+					r = _gzip_response(r, response, env.get('HTTP_ACCEPT_ENCODING', ''), gzip)
 				start_response(response.status, response.headers)
 				return r
 			except RedirectError, e:
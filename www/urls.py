@@ -7,7 +7,8 @@ import os, re, time, base64, hashlib, logging
 
 import markdown2
 
-from transwarp.web import get, post, ctx, view, interceptor, seeother, notfound
+from transwarp import db
+from transwarp.web import get, post, ctx, view, interceptor, conditional, seeother, notfound
 
 from apis import api, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
 from models import User, Blog, Comment
@@ -38,7 +39,7 @@ def parse_signed_cookie(cookie_str):
 		id, expires, md5 = L
 		if int(expires) < time.time():
 			return None
-		user = User.get(id)
+		user = User.get(id, frozen=True)
 		if user is None:
 			return None
 		if md5 != hashlib.md5('%s-%s-%s-%s' % (id, user.password, expires, __COOKIE_KEY)).hexdigest():
@@ -68,26 +69,45 @@ def user_interceptor(next):
 
 @interceptor('/manage/')
 def manage_interceptor(next):
-	user = xtx.request.user
+	user = ctx.request.user
 	if user and user.admin:
 		return next()
 	raise seeother('/signin')
 
+def _user_id():
+	user = ctx.request.user
+	return user and user.id
+
+def _index_version():
+	# any insert, update or delete of a blog changes the count or the latest updated_at,
+	# which update() and update_where() set; the count comes from the count cache:
+	updated_at = db.select_one_row('select max(`updated_at`) from `blogs`')[1][0]
+	return (_get_page_index(), Blog.count_all(), updated_at, _user_id()), updated_at
+
+def _blog_version(blog_id):
+	blog = Blog.get(blog_id, frozen=True)
+	if blog is None:
+		return None
+	count, commented_at = db.select_one_row('select count(*), max(`updated_at`) from `comments` where `blog_id`=?', blog_id)[1]
+	return (blog.id, blog.updated_at, count, commented_at, _user_id()), max(blog.updated_at, commented_at or 0)
+
+@conditional(_index_version)
 @view('blogs.html')
 @get('/')
 def index():
 	blogs,page = _get_blogs_by_page()
 	return dict(page=page, blogs=blogs, user=ctx.request.user)
 
+@conditional(_blog_version)
 @view('blog.html')
 @get('/blog/:blog_id')
 def blog(blog_id):
-	blog = Blog.get(blog_id)
+	blog = Blog.get(blog_id, frozen=True)
 	if blog is None:
 		raise notfound()
-	blog.html_content = markdown2.markdown(blog.content)
+	html_content = markdown2.markdown(blog.conntent)
 	comments = Comment.find_by('where blog_id=? order by created_at desc limit 10000', blog_id)
-	return dict(blog=blog, comments=comments, user=ctx.request.user)
+	return dict(blog=blog, html_content=html_content, comments=comments, user=ctx.request.user)
 
 @view('signin.html')
 @get('/signin')
@@ -134,11 +154,10 @@ def register_user():
 		raise APIValueError('email')
 	if not password or not _RE_MD5.match(password):
 		raise APIValueError('password')
-	user = User.find_first('where email=?', email)
-	if user:
-		raise APIError('register:failed', 'email', 'Email is already in use.')
 	user = User(name=name, email=email, password=password, image='http://gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email).hexdigest())
-	user.insert()
+	# the unique key on email rejects concurrent signups with the same email:
+	if not user.insert(ignore_duplicates=True):
+		raise APIError('register:failed', 'email', 'Email is already in use.')
 	# make session cookie:
 	cookie = make_signed_cookie(user.id, user.password, None)
 	ctx.response.set_cookie(_COOKIE_NAME, cookie)
@@ -160,7 +179,7 @@ def manage_blogs_create():
 	return dict(id=None, action='/api/blogs', redirect='/manage/blogs', user=ctx.request.user)
 
 @api
-@get('api/blogs')
+@get('/api/blogs')
 def api_get_blogs():
 	format = ctx.request.get('format', '')
 	blogs, page = _get_blogs_by_page()
@@ -170,10 +189,7 @@ def api_get_blogs():
 	return dict(blogs=blogs, page=page)	
 
 def _get_blogs_by_page():
-	total = Blog.count_all()
-	page = Page(total, _get_page_index())
-	blogs = Blog.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
-	return blogs, page
+	return Blog.find_page('order by created_at desc', (), _get_page_index())
 
 @api
 @post('/api/blogs')
@@ -197,7 +213,7 @@ def api_create_blog():
 @api
 @get('/api/users')
 def api_get_users():
-	users = User.find_by('order by create_at desc')
+	users = User.find_by('order by created_at desc')
 	for u in users:
 		u.password = '******'
 	return dict(users=users)
\ No newline at end of file
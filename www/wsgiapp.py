@@ -13,10 +13,13 @@ import os, time
 from datetime import datetime
 
 from transwarp import db
-from transwarp.web import WSGIApplication, Jinja2TemplateEngine
+from transwarp.orm import on_change
+from transwarp.web import WSGIApplication, Jinja2TemplateEngine, PageCache
 
 from config import configs
 
+import assets
+
 def datetime_filter(t):
 	delta = int(time.time() - t)
 	if delta < 60:
@@ -33,11 +36,21 @@ def datetime_filter(t):
 # init db:
 db.create_engine(**configs.db)
 
-# init wsgi app:
-wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+# rebuild the stale static bundles and .gz sidecars before they are hashed;
+# on a read-only deploy they are built by 'python assets.py' beforehand:
+try:
+	assets.build()
+except (OSError, IOError), e:
+	logging.warning('Cannot build static assets: %s' % e)
+
+# init wsgi app; static files are served by the app also in production, since
+# the fingerprinted names of {{ static(...) }} exist only in its manifest:
+wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)), static=True)
 
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'template'))
+template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
 template_engine.add_filter('datetime', datetime_filter)
+# fingerprinted urls of static files, by {{ static('js/awesome.js') }}:
+template_engine.add_global('static', wsgi.static_manifest.url)
 
 wsgi.template_engine = template_engine
 
@@ -48,4 +61,19 @@ wsgi.add_interceptor(urls.manage_interceptor)
 wsgi.add_module(urls)
 
 if __name__ == '__main__':
-	wsgi.run(9000, host='0.0.0.0')
\ No newline at end of file
+	wsgi.run(9000, host='0.0.0.0')
+else:
+	# served by a WSGI server, e.g. gunicorn wsgiapp:application;
+	# pages of anonymous readers are cached until a blog or comment changes:
+	application = PageCache(wsgi.get_wsgi_application(), **configs.page_cache)
+
+	from models import Blog, Comment
+
+	@on_change(Blog)
+	def _invalidate_blog_pages(op, model, pk, changed_fields):
+		application.invalidate('/', '/api/blogs', '/blog/%s' % pk)
+
+	@on_change(Comment)
+	def _invalidate_comment_pages(op, model, pk, changed_fields):
+		# the listener only gets the pk of the comment, not its blog:
+		application.invalidate_prefix('/blog/')
\ No newline at end of file